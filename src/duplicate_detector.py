@@ -0,0 +1,196 @@
+# coding: utf-8
+###############################################################################
+#    同じマークシートの重複スキャンを検出します。
+###############################################################################
+import numpy as np
+import os
+import json
+import hashlib
+from typing import List, Tuple
+
+# 独自モジュール
+from logger import Logger
+
+
+def compute_page_hash(area_rates: np.ndarray, fill_levels: List[float]) \
+        -> int:
+    """セルごとの塗りつぶし割合から、ページのハッシュ値を求めます。
+    各セルについて、塗りつぶし割合が fill_levels の各段階を超えるかどうかを１ビットずつ並べます。
+    用紙の傾きやスキャンのむらで割合が少し変わっても数ビットしか変わらず、
+    マークが１つ増減すると段階の数だけビットが変わります。
+
+    Arguments:
+        area_rates {np.ndarray} -- compute_area_rates で求めた塗りつぶし割合 (全体の行数, 列数)
+        fill_levels {List[float]} -- ビットに変換する塗りつぶし割合の段階
+    Returns:
+        int -- area_rates.size * len(fill_levels) ビットのハッシュ値
+    """
+    bits = area_rates.reshape(-1, 1) > np.asarray(fill_levels)
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), "big")
+
+
+def file_digest(file_path: str) -> str:
+    """ファイルの内容のダイジェストを求めます。
+
+    Arguments:
+        file_path {str} -- ファイル名
+    Returns:
+        str -- ファイルの内容の SHA-256 (16進数の文字列)
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DuplicateDetector():
+    """ページ番号ごとにハッシュ値を索引に登録し、ほぼ同じページが既に読み込まれていないかを調べます。
+    ハッシュ値を max_distance + 1 個の区間に分けて区間ごとに索引を作るため、
+    ハミング距離が max_distance 以下のページは必ずいずれかの区間が完全一致し、１ページあたり定数時間で調べられます。
+    ハッシュ値が近いだけのページは、回答がまったく同じ別の用紙の可能性があるため疑いとして報告するだけにとどめ、
+    ファイルの内容のダイジェストが一致するページだけを同じファイルの重複 (exact) とします。
+    ファイル名とダイジェストがともに一致するページは同じファイルの読み直しとみなし、重複としません。
+    """
+
+    def __init__(self, max_distance: int, hash_bits: int,
+                 index_path: str = None):
+        """コンストラクター
+
+        Arguments:
+            max_distance {int} -- 重複とみなすハミング距離の上限
+            hash_bits {int} -- ハッシュ値のビット数
+            index_path {str} -- 索引を保存するファイル名。None または空文字の場合は保存しない
+        """
+        self.logger = Logger("DuplicateDetector")
+        self.max_distance = max_distance
+        self.hash_bits = hash_bits
+        self.index_path = index_path
+
+        # ハッシュ値を分割する区間 (開始ビット, ビット数)
+        n_band = max_distance + 1
+        band_bits = [
+            hash_bits // n_band + (1 if i < hash_bits % n_band else 0)
+            for i in range(n_band)
+        ]
+        self.bands = [
+            (sum(band_bits[:i]), band_bits[i]) for i in range(n_band)
+        ]
+
+        # 登録済みの (ページ番号, ハッシュ値, ファイル名, ダイジェスト)、ダイジェストごとの登録位置、区間ごとの索引
+        self.entries = []
+        self.digest_entries = {}
+        self.index = {}
+
+        if self.index_path and os.path.isfile(self.index_path):
+            with open(self.index_path, encoding="utf-8") as f:
+                saved = json.load(f)
+            if not isinstance(saved, dict) or \
+                    saved.get("hash_bits") != self.hash_bits or \
+                    any(len(x) != 4 for x in saved.get("entries", [])):
+                # ハッシュ値の形式が異なる索引とは比較できない
+                self.logger.log_warn(
+                    "ハッシュ値の形式が異なるため、重複検出の索引を読み込みません" +
+                    f" :index_path={self.index_path}"
+                )
+                return
+            for page_number, page_hash, file_name, digest in saved["entries"]:
+                self._add(page_number, page_hash, file_name, digest)
+            self.logger.log_info(
+                f"重複検出の索引を読み込みました :entries={len(self.entries)}"
+            )
+
+    def check(self, page_number: int, page_hash: int, file_name: str,
+              digest: str) -> Tuple[str, int, bool]:
+        """同じファイルやほぼ同じ画像が既に登録されていないかを調べます。
+        同じファイルの重複でなければ登録します。
+
+        Arguments:
+            page_number {int} -- ページ番号
+            page_hash {int} -- compute_page_hash で求めたハッシュ値
+            file_name {str} -- ファイル名
+            digest {str} -- file_digest で求めたファイルの内容のダイジェスト。None の場合は内容の一致を調べない
+        Returns:
+            Tuple[str, int, bool] --
+                str -- 重複元のファイル名。重複していない場合は None
+                int -- 重複元とのハミング距離。重複していない場合は None
+                bool -- ファイルの内容まで一致する重複かどうか
+        """
+        i = None if digest is None else self.digest_entries.get(digest)
+        if i is not None:
+            other_file_name = self.entries[i][2]
+            if other_file_name == file_name:
+                # 同じファイルの読み直しは重複としない
+                return None, None, False
+            return other_file_name, 0, True
+
+        # ハッシュ値が近いだけの場合は、別の用紙の可能性があるので登録する
+        page_number = int(page_number)
+        duplicate_of, distance = self._find_similar(page_number, page_hash)
+        self._add(page_number, page_hash, file_name, digest)
+        return duplicate_of, distance, False
+
+    def save(self):
+        """索引をファイルに保存します。保存先が設定されていない場合は何もしません。
+        """
+        if not self.index_path:
+            return
+        with open(self.index_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"hash_bits": self.hash_bits, "entries": self.entries}, f,
+                ensure_ascii=False
+            )
+        self.logger.log_info(
+            f"重複検出の索引を保存しました :entries={len(self.entries)}"
+        )
+
+    def _find_similar(self, page_number: int, page_hash: int) \
+            -> Tuple[str, int]:
+        """ハミング距離が max_distance 以下の登録済みページを探します。
+
+        Arguments:
+            page_number {int} -- ページ番号
+            page_hash {int} -- ハッシュ値
+        Returns:
+            Tuple[str, int] --
+                str -- 見つかったページのファイル名。見つからなかった場合は None
+                int -- 見つかったページとのハミング距離。見つからなかった場合は None
+        """
+        for key in self._band_keys(page_number, page_hash):
+            for i in self.index.get(key, []):
+                _, other_hash, other_file_name, _ = self.entries[i]
+                distance = bin(page_hash ^ other_hash).count("1")
+                if distance <= self.max_distance:
+                    return other_file_name, distance
+        return None, None
+
+    def _add(self, page_number: int, page_hash: int, file_name: str,
+             digest: str):
+        """ハッシュ値を索引に登録します。
+
+        Arguments:
+            page_number {int} -- ページ番号
+            page_hash {int} -- ハッシュ値
+            file_name {str} -- ファイル名
+            digest {str} -- ファイルの内容のダイジェスト
+        """
+        i = len(self.entries)
+        self.entries.append((page_number, page_hash, file_name, digest))
+        if digest is not None:
+            self.digest_entries[digest] = i
+        for key in self._band_keys(page_number, page_hash):
+            self.index.setdefault(key, []).append(i)
+
+    def _band_keys(self, page_number: int, page_hash: int) -> List[Tuple]:
+        """ハッシュ値を区間に分け、区間ごとの索引のキーを返します。
+
+        Arguments:
+            page_number {int} -- ページ番号
+            page_hash {int} -- ハッシュ値
+        Returns:
+            List[Tuple] -- (ページ番号, 区間番号, 区間の値) のリスト
+        """
+        return [
+            (page_number, i, (page_hash >> start) & ((1 << bits) - 1))
+            for i, (start, bits) in enumerate(self.bands)
+        ]
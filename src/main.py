@@ -11,14 +11,23 @@ import math
 import argparse
 import pathlib
 import json
+import time
+import queue
+import multiprocessing
 from tqdm import tqdm
 from configparser import ConfigParser
 from typing import Any, Dict, List, Tuple, List
 
 # 独自モジュール
 from marksheet_reader import MarksheetReader
+from duplicate_detector import compute_page_hash, file_digest
+from run_stats import (
+    RunStats, STAGE_RECOGNIZED, STAGE_PAGE_UNKNOWN, STAGE_DUPLICATE_SKIPPED
+)
 from logger import Logger
 
+# 並列処理で、子プロセスと親プロセスの生存を確認する間隔 (秒)
+WORKER_POLL_SEC = 1.0
 
 # コマンドライン引数
 parser = argparse.ArgumentParser()
@@ -39,6 +48,28 @@ parser.add_argument(
     default=0.5,
     help="マーカー点の認識閾値を指定して下さい。デフォルト値は 0.5 です。"
 )
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=0,
+    help="画像の読み込みを並列で行うプロセス数を指定して下さい。デフォルト値は 0 (並列化しない) です。"
+)
+parser.add_argument(
+    "--calibrate",
+    action="store_true",
+    help="このオプションが指定された場合は、画像の一部から各種閾値を自動で決めてから読み取ります。"
+)
+parser.add_argument(
+    "--skip-duplicates",
+    action="store_true",
+    help="このオプションが指定された場合は、内容がまったく同じファイルを集計から除外します。"
+)
+parser.add_argument(
+    "--stats-port",
+    type=int,
+    default=0,
+    help="読み取り中の統計情報をテキストで公開するローカルホストのポート番号を指定して下さい。デフォルト値は 0 (公開しない) です。"
+)
 COMMANDLINE_OPTIONS = parser.parse_args()
 
 
@@ -120,14 +151,15 @@ def init_answer_columns(reader: MarksheetReader) -> Tuple[
     return n_page, answers, answer_tables, data_sums
 
 
-def init_warning_results() -> Tuple[List, List, List]:
+def init_warning_results() -> Tuple[List, List, List, List]:
     """要注意結果のデータフレームを初期化します。
 
     Returns:
-        Tuple[List, List, List] --
+        Tuple[List, List, List, List] --
             List -- 複数回答
             List -- 無回答
             List -- 読み取りエラー
+            List -- 重複スキャン
     """
     # 複数回答の一覧
     multi_ans = pd.DataFrame({
@@ -152,13 +184,26 @@ def init_warning_results() -> Tuple[List, List, List]:
     })
     no_recognize = no_recognize.ix[:, ["ファイル名", ]]
 
-    return multi_ans, no_ans, no_recognize
+    # 重複スキャンの一覧
+    duplicates = pd.DataFrame({
+        "ファイル名": [],
+        "ページ番号": [],
+        "重複元ファイル名": [],
+        "距離": [],
+        "同一ファイル": [],
+    })
+    duplicates = duplicates.ix[
+        :, ["ファイル名", "ページ番号", "重複元ファイル名", "距離", "同一ファイル"]
+    ]
+
+    return multi_ans, no_ans, no_recognize, duplicates
 
 
 def process_summarize(reader: MarksheetReader, file_name: str, answers: List,
                       data_sums: List, multi_ans: List, no_ans: List,
-                      no_recognize: List, answer_tables: List) -> Tuple[
-                          List, List, List]:
+                      no_recognize: List, duplicates: List,
+                      answer_tables: List, stats: RunStats = None) -> Tuple[
+                          List, List, List, List]:
     """与えられた画像ファイルを読み込み、結果を格納します。
 
     Arguments:
@@ -168,28 +213,82 @@ def process_summarize(reader: MarksheetReader, file_name: str, answers: List,
         multi_ans {List} -- 複数回答のリスト
         no_ans {List} -- 無回答のリスト
         no_recognize {List} -- 認識できなかったファイルのリスト
+        duplicates {List} -- 重複スキャンのリスト
         answer_tables {List} -- 個人単位での読み取り結果のリスト
+        stats {RunStats} -- 読み取り結果の統計。None の場合は記録しない
 
     Returns:
-        Tuple[List, List, List] --
+        Tuple[List, List, List, List] --
             List -- 更新後の multi_ans
             List -- 更新後の no_ans
             List -- 更新後の no_recognize
+            List -- 更新後の duplicates
     """
-    logger = Logger("process_summarize")
     file_path = os.path.join(COMMANDLINE_OPTIONS.imgdir, file_name)
 
     # 現在のファイルに対して回答チェック
-    logger.log_debug(file_path)
+    Logger("process_summarize").log_debug(file_path)
 
+    started = time.perf_counter()
     image = reader.load_marksheet(file_path)
+    digest = None if image is None else file_digest(file_path)
+    return summarize_image(
+        reader, file_name, image, answers,
+        data_sums, multi_ans, no_ans,
+        no_recognize, duplicates, answer_tables,
+        stats, reader.last_error, time.perf_counter() - started, digest
+    )
+
+
+def summarize_image(reader: MarksheetReader, file_name: str,
+                    image: np.ndarray, answers: List, data_sums: List,
+                    multi_ans: List, no_ans: List, no_recognize: List,
+                    duplicates: List, answer_tables: List,
+                    stats: RunStats = None, load_error: str = None,
+                    load_sec: float = 0.0, digest: str = None) -> Tuple[
+                        List, List, List, List]:
+    """読み込み済みの画像を認識し、結果を格納します。
+
+    Arguments:
+        reader {MarksheetReader} -- マークシートリーダーオブジェクト
+        file_name {str} -- 読み込み対象のファイル名（基準画像ディレクトリーまでの文字列を除いたもの）
+        image {np.ndarray} -- load_marksheet で整形した画像。読み込みに失敗した場合は None
+        data_sums {List} -- ページごと設問ごとの集計結果
+        multi_ans {List} -- 複数回答のリスト
+        no_ans {List} -- 無回答のリスト
+        no_recognize {List} -- 認識できなかったファイルのリスト
+        duplicates {List} -- 重複スキャンのリスト
+        answer_tables {List} -- 個人単位での読み取り結果のリスト
+        stats {RunStats} -- 読み取り結果の統計。None の場合は記録しない
+        load_error {str} -- 読み込みに失敗した場合の MarksheetReader.last_error
+        load_sec {float} -- 画像の読み込みにかかった時間 (秒)
+        digest {str} -- file_digest で求めたファイルの内容のダイジェスト
+
+    Returns:
+        Tuple[List, List, List, List] --
+            List -- 更新後の multi_ans
+            List -- 更新後の no_ans
+            List -- 更新後の no_recognize
+            List -- 更新後の duplicates
+    """
+    logger = Logger("summarize_image")
+    file_path = os.path.join(COMMANDLINE_OPTIONS.imgdir, file_name)
+    started = time.perf_counter()
+
+    def record(stage: str):
+        if stats is not None:
+            stats.record(
+                file_name, stage, load_sec + time.perf_counter() - started
+            )
+
     if image is None:
         # 認識エラー: 歪んでいるなどにより、マーカーを認識できなかった
         no_recognize = no_recognize.append(
             pd.Series([file_name], index=no_recognize.columns),
             ignore_index=True
         )
-        return multi_ans, no_ans, no_recognize
+        record(load_error)
+        return multi_ans, no_ans, no_recognize, duplicates
 
     # マーク読み取り実行
     page_number, results = reader.recognize_marksheet(image, file_path)
@@ -200,7 +299,40 @@ def process_summarize(reader: MarksheetReader, file_name: str, answers: List,
             pd.Series([file_name], index=no_recognize.columns),
             ignore_index=True
         )
-        return multi_ans, no_ans, no_recognize
+        record(STAGE_PAGE_UNKNOWN)
+        return multi_ans, no_ans, no_recognize, duplicates
+
+    # 重複スキャンの検出 (ハッシュ値が近いだけのページは回答が同じ別の用紙の可能性があるので除外しない)
+    duplicate_of, distance, exact = reader.duplicate_detector.check(
+        page_number,
+        compute_page_hash(
+            reader.last_area_rates, reader.duplicate_fill_levels
+        ),
+        file_name,
+        digest
+    )
+    if duplicate_of is not None:
+        logger.log_warn(
+            f"重複スキャンの疑い :file_name={file_name}" +
+            f" :duplicate_of={duplicate_of} :distance={distance}" +
+            f" :exact={exact}"
+        )
+        duplicates = duplicates.append(
+            pd.Series(
+                [
+                    file_name,
+                    f"{page_number}",
+                    duplicate_of,
+                    f"{distance}",
+                    exact,
+                ],
+                index=duplicates.columns
+            ),
+            ignore_index=True
+        )
+        if exact and COMMANDLINE_OPTIONS.skip_duplicates:
+            record(STAGE_DUPLICATE_SKIPPED)
+            return multi_ans, no_ans, no_recognize, duplicates
 
     answers[page_number - 1].append(os.path.basename(file_path))
     answers[page_number - 1].append("")
@@ -276,23 +408,194 @@ def process_summarize(reader: MarksheetReader, file_name: str, answers: List,
                 answer_table_row, ignore_index=True)
 
     answers[page_number - 1].append("\n--------------------------------\n")
-    return multi_ans, no_ans, no_recognize
+    record(STAGE_RECOGNIZED)
+    return multi_ans, no_ans, no_recognize, duplicates
+
+
+def decode_worker(ring: "SharedPageRing", reader: MarksheetReader,
+                  file_names: List):
+    """子プロセスで画像を読み込み、整形した画像を共有メモリーのスロットに直接書き込みます。
+    画像には (ファイル名, 読み込みエラーの段階, 読み込み時間, ファイルの内容のダイジェスト) を付随させ、
+    最後に終了の合図として (None, None) を受け渡します。
+
+    Arguments:
+        ring {SharedPageRing} -- 受け渡し先のリングバッファー
+        reader {MarksheetReader} -- マークシートリーダーオブジェクト
+        file_names {List} -- このプロセスで読み込むファイル名のリスト
+    """
+    try:
+        for file_name in file_names:
+            file_path = os.path.join(COMMANDLINE_OPTIONS.imgdir, file_name)
+            slot = acquire_slot(ring)
+            started = time.perf_counter()
+            if reader.load_marksheet(file_path, out=ring.view(slot)) is None:
+                # 読み込みエラーはスロットを返却し、スロットを使わずに通知する
+                ring.release(slot)
+                ring.publish(None, (
+                    file_name, reader.last_error,
+                    time.perf_counter() - started, None
+                ))
+                continue
+
+            digest = file_digest(file_path)
+            ring.publish(slot, (
+                file_name, None, time.perf_counter() - started, digest
+            ))
+    finally:
+        # 途中で例外が発生しても、親プロセスが待ち続けないように終了を通知する
+        ring.publish(None, None)
+        ring.close()
+
+
+def acquire_slot(ring: "SharedPageRing") -> int:
+    """子プロセスで空きスロットを取得します。
+    親プロセスが異常終了してスロットが返却されなくなった場合は、待ち続けずに例外を送出します。
+
+    Arguments:
+        ring {SharedPageRing} -- 受け渡し先のリングバッファー
+    Returns:
+        int -- スロット番号
+    """
+    while True:
+        try:
+            return ring.acquire(timeout=WORKER_POLL_SEC)
+        except queue.Empty:
+            if not multiprocessing.parent_process().is_alive():
+                raise RuntimeError("親プロセスが終了しました")
+
+
+def check_workers(workers: List, all_finished: bool):
+    """子プロセスが異常終了していないかを確認し、異常終了していた場合は例外を送出します。
+
+    Arguments:
+        workers {List} -- 子プロセスのリスト
+        all_finished {bool} -- すべての子プロセスから終了の合図を受け取ったかどうか
+    """
+    failed = [
+        x for x in workers
+        if x.exitcode is not None and x.exitcode != 0
+    ]
+    if len(failed) > 0:
+        raise RuntimeError(
+            "画像を読み込む子プロセスが異常終了しました" +
+            f" :exitcodes={[x.exitcode for x in failed]}"
+        )
+    if not all_finished and all(x.exitcode is not None for x in workers):
+        raise RuntimeError("画像を読み込む子プロセスが終了の合図を送らずに終了しました")
+
+
+def process_summarize_parallel(
+        reader: MarksheetReader, files: List, answers: List, data_sums: List,
+        multi_ans: List, no_ans: List, no_recognize: List, duplicates: List,
+        answer_tables: List, stats: RunStats = None) -> Tuple[
+            List, List, List, List]:
+    """画像の読み込みを子プロセスに分担させ、認識と集計をこのプロセスで行います。
+    整形後の画像は共有メモリーを介してコピーせずに受け取ります。
+    集計の順序は読み込みが終わった順になるため、実行のたびに変わることがあります。
+    重複スキャンのどちらを重複元とするかも、この順序で決まります。
+    子プロセスが異常終了した場合や集計中に例外が発生した場合は、子プロセスを終了させてから例外を送出します。
+
+    Arguments:
+        reader {MarksheetReader} -- マークシートリーダーオブジェクト
+        files {List} -- 読み込み対象のファイル名のリスト
+        data_sums {List} -- ページごと設問ごとの集計結果
+        multi_ans {List} -- 複数回答のリスト
+        no_ans {List} -- 無回答のリスト
+        no_recognize {List} -- 認識できなかったファイルのリスト
+        duplicates {List} -- 重複スキャンのリスト
+        answer_tables {List} -- 個人単位での読み取り結果のリスト
+        stats {RunStats} -- 読み取り結果の統計。None の場合は記録しない
+
+    Returns:
+        Tuple[List, List, List, List] --
+            List -- 更新後の multi_ans
+            List -- 更新後の no_ans
+            List -- 更新後の no_recognize
+            List -- 更新後の duplicates
+    """
+    # 共有メモリーは Python 3.8 以上でしか使えないため、並列化するときだけ読み込む
+    from shared_page_ring import SharedPageRing
+
+    n_worker = COMMANDLINE_OPTIONS.workers
+    shape = (
+        reader.total_row * reader.cell_size,
+        reader.n_col * reader.cell_size
+    )
+
+    with SharedPageRing(reader.ring_slots, shape) as ring:
+        workers = [
+            multiprocessing.Process(
+                target=decode_worker,
+                args=(ring, reader, files[i::n_worker]),
+                daemon=True
+            )
+            for i in range(n_worker)
+        ]
+        for worker in workers:
+            worker.start()
+
+        slot = None
+        image = None
+        try:
+            with tqdm(total=len(files)) as progress:
+                n_finished = 0
+                while n_finished < n_worker:
+                    try:
+                        slot, item = ring.get(timeout=WORKER_POLL_SEC)
+                    except queue.Empty:
+                        check_workers(workers, False)
+                        continue
+                    if item is None:
+                        n_finished += 1
+                        continue
+
+                    file_name, load_error, load_sec, digest = item
+                    image = None if slot is None else ring.view(slot)
+                    multi_ans, no_ans, no_recognize, duplicates = \
+                        summarize_image(
+                            reader, file_name, image, answers,
+                            data_sums, multi_ans, no_ans,
+                            no_recognize, duplicates, answer_tables,
+                            stats, load_error, load_sec, digest
+                        )
+                    image = None
+                    ring.release(slot)
+                    slot = None
+                    progress.update()
+        finally:
+            # 例外で中断した場合も、スロットを返却して view を破棄してから共有メモリーを閉じる
+            ring.release(slot)
+            del image
+            # 空きスロットを待っている子プロセスが残らないように終了させる
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+                worker.join()
+
+        check_workers(workers, True)
+
+    return multi_ans, no_ans, no_recognize, duplicates
 
 
 def print_summary(
-            reader: MarksheetReader, n_page: int, data_sums: List,
-            multi_ans: List, no_ans: List, no_recognize: List,
-            answer_tables: List):
+            reader: MarksheetReader, n_page: int, answers: List,
+            data_sums: List, multi_ans: List, no_ans: List,
+            no_recognize: List, duplicates: List, answer_tables: List,
+            stats: RunStats = None, calibration: Dict = None):
     """マークシートの集計結果を標準出力・ファイルに出力します。
 
     Arguments:
         reader {MarksheetReader} -- マークシートリーダーオブジェクト
         n_page {int} -- フォームのページ数
+        answers {List} -- ページごとの個別回答テキスト
         data_sums {List} -- ページごと設問ごとの集計結果
         multi_ans {List} -- 複数回答のリスト
         no_ans {List} -- 無回答のリスト
         no_recognize {List} -- 認識できなかったファイルのリスト
+        duplicates {List} -- 重複スキャンのリスト
         answer_tables {List} -- 個人単位での読み取り結果のリスト
+        stats {RunStats} -- 読み取り結果の統計。None の場合は実行レポートを出力しない
+        calibration {Dict} -- 閾値の自動調整結果。自動調整していない場合は None
     """
     logger = Logger("print_summary")
 
@@ -301,7 +604,8 @@ def print_summary(
         logger.log_debug(f"Page:{i + 1}\n{data_sums[i]}\n")
     logger.log_debug(f"◆複数回答\n{multi_ans}\n")
     logger.log_debug(f"◆無回答\n{no_ans}\n")
-    logger.log_debug(f"◆認識エラー\n{no_recognize}\n\n")
+    logger.log_debug(f"◆認識エラー\n{no_recognize}\n")
+    logger.log_debug(f"◆重複スキャン\n{duplicates}\n\n")
 
     # 集計データをCSVに出力
     if not os.path.isdir(reader.summary_dir):
@@ -338,6 +642,25 @@ def print_summary(
         index=False,
         encoding="sjis"
     )
+    duplicates.to_csv(
+        os.path.join(reader.summary_dir, "duplicates.csv"),
+        index=False,
+        encoding="sjis"
+    )
+
+    # 読み取り結果の統計と、実際に使った閾値を実行レポートとして書き出し
+    if stats is not None:
+        logger.log_info(f"◆統計\n{stats.to_text()}")
+        stats.write_report(reader.summary_dir, {
+            "options": vars(COMMANDLINE_OPTIONS),
+            "thresholds": {
+                "marker_threshold": reader.marker_threshold,
+                "gray_threshold": reader.gray_threshold,
+                "result_threshold_minrate": reader.result_threshold_minrate,
+            },
+            "calibration": calibration,
+            "duplicates": len(duplicates),
+        })
 
     # ページごと、ファイルごとの個別回答情報を書き出し
     for i, answer_page in enumerate(answers):
@@ -367,25 +690,53 @@ if __name__ == "__main__":
         f"コマンドライン引数" +
         f" :imgdir={COMMANDLINE_OPTIONS.imgdir}" +
         f" :verbose={COMMANDLINE_OPTIONS.verbose}" +
-        f" :threshold={COMMANDLINE_OPTIONS.threshold}"
+        f" :threshold={COMMANDLINE_OPTIONS.threshold}" +
+        f" :workers={COMMANDLINE_OPTIONS.workers}" +
+        f" :calibrate={COMMANDLINE_OPTIONS.calibrate}" +
+        f" :skip_duplicates={COMMANDLINE_OPTIONS.skip_duplicates}" +
+        f" :stats_port={COMMANDLINE_OPTIONS.stats_port}"
     )
 
     # 各種テーブル初期化
     n_page, answers, answer_tables, data_sums = init_answer_columns(reader)
-    multi_ans, no_ans, no_recognize = init_warning_results()
+    multi_ans, no_ans, no_recognize, duplicates = init_warning_results()
 
     # マークシートのスキャン画像を逐一読み取って集計
     files = os.listdir(COMMANDLINE_OPTIONS.imgdir)
+
+    # 閾値の自動調整
+    calibration = None
+    if COMMANDLINE_OPTIONS.calibrate:
+        logger.log_info("閾値の自動調整開始...")
+        calibration = reader.calibrate([
+            os.path.join(COMMANDLINE_OPTIONS.imgdir, x) for x in files
+        ])
+
+    # 読み取り結果の統計
+    stats = RunStats(len(files), reader.stats_window, reader.stats_n_slowest)
+    if COMMANDLINE_OPTIONS.stats_port > 0:
+        stats.serve(COMMANDLINE_OPTIONS.stats_port)
+
     logger.log_info("マークシート読み取り開始...")
-    for file in tqdm(files):
-        multi_ans, no_ans, no_recognize = process_summarize(
-            reader, file, answers,
-            data_sums, multi_ans, no_ans,
-            no_recognize, answer_tables
-        )
+    if COMMANDLINE_OPTIONS.workers > 0:
+        multi_ans, no_ans, no_recognize, duplicates = \
+            process_summarize_parallel(
+                reader, files, answers,
+                data_sums, multi_ans, no_ans,
+                no_recognize, duplicates, answer_tables, stats
+            )
+    else:
+        for file in tqdm(files):
+            multi_ans, no_ans, no_recognize, duplicates = process_summarize(
+                reader, file, answers,
+                data_sums, multi_ans, no_ans,
+                no_recognize, duplicates, answer_tables, stats
+            )
+    stats.finish()
+    reader.duplicate_detector.save()
 
     # 結果を出力
     print_summary(
-        reader, n_page, data_sums, multi_ans, no_ans,
-        no_recognize, answer_tables
+        reader, n_page, answers, data_sums, multi_ans, no_ans,
+        no_recognize, duplicates, answer_tables, stats, calibration
     )
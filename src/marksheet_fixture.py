@@ -0,0 +1,65 @@
+# coding: utf-8
+###############################################################################
+#    テスト用に、設定どおりのレイアウトを持つマークシートのスキャン画像を生成します。
+###############################################################################
+import numpy as np
+import cv2
+from typing import List
+
+# 独自モジュール
+from marksheet_reader import MarksheetReader
+
+
+def make_marksheet_image(reader: MarksheetReader, page_number: int,
+                         answers: List, cell_width: int = 200,
+                         cell_height: int = 50) -> np.ndarray:
+    """マーカー３点とマーク欄を描いた、白地に黒のグレースケール画像を生成します。
+
+    Arguments:
+        reader {MarksheetReader} -- マークシートリーダーオブジェクト
+        page_number {int} -- 塗りつぶすページ番号 (1 origin)。0 の場合は塗りつぶさない
+        answers {List} -- 設問ごとに塗りつぶす回答番号 (1 origin) のリスト
+        cell_width {int} -- スキャン画像上の１列あたりの幅 (px)
+        cell_height {int} -- スキャン画像上の１行あたりの高さ (px)
+    Returns:
+        np.ndarray -- 生成した画像
+    """
+    _, marker = cv2.threshold(
+        reader.marker, reader.gray_threshold, 255, cv2.THRESH_BINARY
+    )
+    marker_height, marker_width = marker.shape
+
+    # マーカーの配置: 左上・右上・右下
+    left = 100
+    top = 100
+    right = left + reader.offset_left + reader.n_col * cell_width
+    bottom = top + marker_height + reader.offset_top + \
+        reader.total_row * cell_height
+    image = np.full(
+        (bottom + marker_height + 100, right + marker_width + 100),
+        255,
+        dtype=np.uint8
+    )
+    for x, y in [(left, top), (right, top), (right, bottom)]:
+        image[y:y + marker_height, x:x + marker_width] = marker
+
+    # マーク領域の原点
+    area_left = left + reader.offset_left
+    area_top = top + marker_height + reader.offset_top
+
+    def fill(row: int, col: int):
+        image[
+            area_top + row * cell_height + cell_height // 5:
+            area_top + (row + 1) * cell_height - cell_height // 5,
+            area_left + col * cell_width + cell_width // 5:
+            area_left + (col + 1) * cell_width - cell_width // 5
+        ] = 0
+
+    if page_number > 0:
+        fill(0, page_number - 1)
+        question_indices = reader.p_question_indices[page_number - 1]
+        for row, answer in zip(question_indices, answers):
+            for col in answer:
+                fill(row, col - 1)
+
+    return image
@@ -9,16 +9,31 @@ import os
 import sys
 import math
 import json
+import random
 from tqdm import tqdm
 from configparser import ConfigParser
-from typing import Any, Dict, List, Tuple, List
+from typing import Any, Dict, List, Tuple, List, Union
 
 # 独自モジュール
 from logger import Logger
+from duplicate_detector import DuplicateDetector
 
 # 定数定義
 MARKER_PATH = "./image/marker.jpg"
 
+# 読み込みエラーの段階
+LOAD_ERROR_EXTENSION = "unsupported_extension"
+LOAD_ERROR_IMREAD = "imread_failed"
+LOAD_ERROR_MARKER = "marker_not_found"
+LOAD_ERROR_CROP = "crop_too_small"
+
+# デコードせずにメモリーマップで読み込む拡張子
+PGM_EXTENSIONS = [".pgm"]
+RAW_EXTENSIONS = [".raw"]
+
+# PGM ヘッダーの最大長 (コメントを含む)
+PGM_HEADER_MAX_BYTES = 4096
+
 # 設定ファイル読み込み
 config = ConfigParser()
 config.read("./config/settings.conf", encoding="utf-8")
@@ -41,6 +56,12 @@ class MarksheetReader():
         self.marker_threshold = threshold
         self.verbose = verbose
 
+        # 直前の load_marksheet で発生した読み込みエラーの段階
+        self.last_error = None
+
+        # 直前の recognize_marksheet で求めたセルごとの塗りつぶし割合
+        self.last_area_rates = None
+
         # マーカー画像をグレースケールで読み込む
         self.marker = cv2.imread(MARKER_PATH, cv2.IMREAD_GRAYSCALE)
         if self.marker is None:
@@ -62,6 +83,13 @@ class MarksheetReader():
         # 各種設定値を読み込む
         self._load_settings()
 
+        # 重複スキャンの検出器
+        self.duplicate_detector = DuplicateDetector(
+            self.duplicate_max_distance,
+            self.total_row * self.n_col * len(self.duplicate_fill_levels),
+            self.duplicate_index_path
+        )
+
     def _load_settings(self):
         """各種設定値を読み込んでメンバー変数に格納します。
         """
@@ -97,6 +125,28 @@ class MarksheetReader():
         self.blur_strength = tuple(
             json.loads(config.get("marksheet", "blur_strength"))
         )
+        self.raw_size = tuple(json.loads(config.get("marksheet", "raw_size")))
+
+        # 重複検出設定
+        self.duplicate_max_distance = config.getint(
+            "duplicate", "max_distance"
+        )
+        self.duplicate_fill_levels = json.loads(
+            config.get("duplicate", "fill_levels")
+        )
+        self.duplicate_index_path = config.get("duplicate", "index_path")
+
+        # 統計設定
+        self.stats_window = config.getint("stats", "window")
+        self.stats_n_slowest = config.getint("stats", "n_slowest")
+
+        # 並列処理設定
+        self.ring_slots = config.getint("pipeline", "ring_slots")
+
+        # 閾値調整設定
+        self.calibration_sample_size = config.getint(
+            "calibration", "sample_size"
+        )
 
         # 集計設定
         self.summary_dir = config.get("summarize", "summary_dir")
@@ -104,29 +154,43 @@ class MarksheetReader():
             config.get("summarize", "p_question_indices")
         )
 
-    def load_marksheet(self, filename: str) -> np.ndarray:
+    def load_marksheet(self, filename: str,
+                       data: Union[bytes, np.ndarray] = None,
+                       out: np.ndarray = None) -> np.ndarray:
         """マークシート画像を読み込み、認識可能な状態に整形します。
-        読み込みに失敗した場合は None を返します。
+        読み込みに失敗した場合は None を返し、失敗した段階を last_error に格納します。
+        data を指定した場合はファイルを読まずに、メモリー上の画像を整形します。
+        out を指定した場合は、整形の最後の段階で out に直接書き込んで out を返します。
 
         Arguments:
             filename {str} -- ファイル名
+            data {Union[bytes, np.ndarray]} -- 画像ファイルの内容、または 8ビットのグレースケールか BGR の画像
+            out {np.ndarray} -- 整形後の画像の書き込み先 (全体の行数 * セルサイズ, 列数 * セルサイズ) の uint8 配列
         Returns:
             np.ndarray -- 抽出したマークシート部分の画像
         """
         basename = os.path.basename(filename)
+        self.last_error = None
         _, ext = os.path.splitext(basename)
-        if ext not in self.supported_extensions:
+        if data is None and ext not in self.supported_extensions:
             self.logger.log_error(
                 f"対応していない拡張子です。設定を変えるか形式を変更して下さい :basename={basename}"
             )
+            self.last_error = LOAD_ERROR_EXTENSION
             return None
 
         # スキャン画像の取り込み
-        image = cv2.imread(filename, cv2.IMREAD_GRAYSCALE)
+        if data is None:
+            image = self.read_image(filename)
+        elif isinstance(data, np.ndarray):
+            image = to_grayscale(data)
+        else:
+            image = self.decode_image(data, ext)
         if image is None:
             self.logger.log_error(
-                f"cv2.imread 失敗。画像形式を確認して下さい :basename={basename}"
+                f"画像の読み込み失敗。画像形式を確認して下さい :basename={basename}"
             )
+            self.last_error = LOAD_ERROR_IMREAD
             return None
 
         # スキャン画像を二値化
@@ -150,6 +214,7 @@ class MarksheetReader():
         loc = np.where(res >= self.marker_threshold)
         if len(loc) == 0 or len(loc[0]) == 0 or len(loc[1]) == 0:
             self.logger.log_error(f"マーカーの認識に失敗 :basename={basename}")
+            self.last_error = LOAD_ERROR_MARKER
             return None
 
         # 認識領域を切り出し
@@ -179,6 +244,7 @@ class MarksheetReader():
             )
         if True in [x < 200 for x in image.shape[:2]]:
             self.logger.log_error(f"切り出した画像が小さすぎる :basename={basename}")
+            self.last_error = LOAD_ERROR_CROP
             return None
 
         # 列数、行数ベースでキリのいいサイズにリサイズ
@@ -188,22 +254,95 @@ class MarksheetReader():
         )
         image = cv2.resize(image, dest_size)
 
-        # 画像に軽くブラーをかけて、白黒反転させる（塗りつぶした部分が白く浮き上がる）
+        # 画像に軽くブラーをかけて、白黒反転させながら二値化する（塗りつぶした部分が白く浮き上がる）
         image = cv2.GaussianBlur(image, self.blur_strength, 0)
         res, image = cv2.threshold(
             image,
             self.gray_threshold,
             255,
-            cv2.THRESH_BINARY
+            cv2.THRESH_BINARY_INV,
+            dst=out
         )
-        image = 255 - image
 
         return image
 
+    def read_image(self, filename: str) -> np.ndarray:
+        """スキャン画像をグレースケールで読み込みます。
+        PGM (P5) と無圧縮のグレースケール画像はデコードせず、ファイルをメモリーマップした配列を返します。
+        読み込めなかった場合は None を返します。
+
+        Arguments:
+            filename {str} -- ファイル名
+        Returns:
+            np.ndarray -- グレースケール画像
+        """
+        _, ext = os.path.splitext(filename)
+        try:
+            if ext in PGM_EXTENSIONS:
+                with open(filename, "rb") as f:
+                    header = f.read(PGM_HEADER_MAX_BYTES)
+                width, height, maxval, offset = parse_pgm_header(header)
+                image = np.memmap(
+                    filename, dtype=pgm_dtype(maxval), mode="r",
+                    offset=offset, shape=(height, width)
+                )
+                return to_uint8(image, maxval)
+            if ext in RAW_EXTENSIONS:
+                width, height = self.raw_size
+                if os.path.getsize(filename) != width * height:
+                    return None
+                return np.memmap(
+                    filename, dtype=np.uint8, mode="r", shape=(height, width)
+                )
+        except (OSError, ValueError):
+            return None
+
+        return cv2.imread(filename, cv2.IMREAD_GRAYSCALE)
+
+    def decode_image(self, data: bytes, ext: str) -> np.ndarray:
+        """メモリー上の画像ファイルの内容を、グレースケール画像にします。
+        PGM (P5) と無圧縮のグレースケール画像はデコードせず、data を直接参照する配列を返します。
+        読み込めなかった場合は None を返します。
+
+        Arguments:
+            data {bytes} -- 画像ファイルの内容
+            ext {str} -- 画像の拡張子
+        Returns:
+            np.ndarray -- グレースケール画像
+        """
+        if len(data) == 0:
+            # 空のデータは cv2.imdecode が例外を送出する
+            return None
+        try:
+            if ext in RAW_EXTENSIONS:
+                width, height = self.raw_size
+                if len(data) != width * height:
+                    return None
+                return np.frombuffer(data, dtype=np.uint8).reshape(
+                    height, width
+                )
+            # 拡張子が PGM でなくても、先頭が P5 なら PGM として読む
+            if ext in PGM_EXTENSIONS or data[:2] == b"P5":
+                width, height, maxval, offset = parse_pgm_header(
+                    data[:PGM_HEADER_MAX_BYTES]
+                )
+                image = np.frombuffer(
+                    data, dtype=pgm_dtype(maxval), count=width * height,
+                    offset=offset
+                )
+                return to_uint8(image.reshape(height, width), maxval)
+        except ValueError:
+            return None
+
+        return cv2.imdecode(
+            np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE
+        )
+
     def recognize_marksheet(self, image: np.ndarray, filename: str) \
             -> Tuple[int, List]:
         """読み込まれたマークシートをもとに、塗りつぶされた項目の列番号を認識して配列で返します。
         ここに渡す画像は二値化されており、かつ１行と１列でサイズが等しいことが前提となります。
+        判定に使ったセルごとの塗りつぶし割合は last_area_rates に格納します。
 
         Arguments:
             image {np.ndarray} -- 読み取り対象の画像
@@ -214,6 +353,48 @@ class MarksheetReader():
                 List -- 各設問に対する回答情報の配列を格納した配列
         """
         basename = os.path.basename(filename)
+
+        if self.verbose:
+            # 行ごとに切り出した画像を出力
+            for row in range(self.total_row - self.margin_bottom):
+                cv2.imwrite(
+                    os.path.join(
+                        self.log_dir,
+                        basename + "-row" + str(row) + ".jpg"
+                    ),
+                    image[row * self.cell_size: (row + 1) * self.cell_size]
+                )
+
+        # 各セルの塗りつぶし割合を求めて判定する
+        self.last_area_rates = self.compute_area_rates(image)
+        return self._judge_marksheet(self.last_area_rates, basename)
+
+    def compute_area_rates(self, image: np.ndarray) -> np.ndarray:
+        """整形済みの画像から、セルごとの塗りつぶし割合 (0.0-1.0) を求めます。
+
+        Arguments:
+            image {np.ndarray} -- 二値化した整形済みの画像 (高さ, 幅)
+        Returns:
+            np.ndarray -- セルごとの塗りつぶし割合 (全体の行数, 列数)
+        """
+        # 積分画像をセルの角で間引き、４隅の差からセル内の画素値の合計を求める
+        corners = cv2.integral(image)[::self.cell_size, ::self.cell_size]
+        area_sum = corners[1:, 1:] - corners[:-1, 1:] - \
+            corners[1:, :-1] + corners[:-1, :-1]
+
+        # 白い部分 (255) の画素数を、全部塗りつぶしたときの理論値で割る
+        return area_sum / (255 * self.cell_size * self.cell_size)
+
+    def _judge_marksheet(self, area_rates: np.ndarray, basename: str) \
+            -> Tuple[int, List]:
+        """セルごとの塗りつぶし割合から、ページ番号と各設問の回答を判定します。
+
+        Arguments:
+            area_rates {np.ndarray} -- セルごとの塗りつぶし割合 (全体の行数, 列数)
+            basename {str} -- ファイル名
+        Returns:
+            Tuple[int, List] -- recognize_marksheet の戻り値と同じ
+        """
         page_number = 0
         results = []
 
@@ -226,32 +407,7 @@ class MarksheetReader():
                 # 設問ではない行
                 continue
 
-            # 処理する行を切り出して 0-1 標準化
-            row_image = image[
-                row * self.cell_size: (row + 1) * self.cell_size,
-            ]
-            if self.verbose:
-                cv2.imwrite(
-                    os.path.join(
-                        self.log_dir,
-                        basename + "-row" + str(row) + ".jpg"
-                    ),
-                    row_image
-                )
-            row_image = row_image / 255.0
-            area_sum = []    # ここに合計値を入れる
-
-            # 列ごとに走査する
-            for col in range(self.n_col):
-                # 各セルの領域について、画像の合計値（＝白い部分の面積）を求める
-                cell_image = row_image[
-                    :,
-                    col * self.cell_size: (col + 1) * self.cell_size
-                ]
-                area_sum.append(np.sum(cell_image))
-
-            # 各セルの合計値を上限値（＝全部塗りつぶしたときの理論値）に対する割合にする
-            area_sum = np.asarray(area_sum) / (self.cell_size * self.cell_size)
+            area_sum = area_rates[row]
             max = np.max(area_sum)
 
             if max < self.result_threshold_minrate:
@@ -286,6 +442,133 @@ class MarksheetReader():
 
         return page_number, results
 
+    def calibrate(self, filenames: List[str]) -> Dict:
+        """画像の一部を抽出して、マーカー点の認識閾値・二値化の閾値・塗りつぶしの最小割合を自動で決めます。
+        決めた値はメンバー変数に反映されます。
+        値を決められなかった項目は現在の値のままとします。
+
+        Arguments:
+            filenames {List[str]} -- 抽出元のファイル名のリスト
+        Returns:
+            Dict -- 決めた閾値と抽出したファイル名
+        """
+        candidates = [
+            x for x in filenames
+            if os.path.splitext(x)[1] in self.supported_extensions
+        ]
+        samples = random.sample(
+            candidates, min(self.calibration_sample_size, len(candidates))
+        )
+        images = [self.read_image(x) for x in samples]
+        images = [x for x in images if x is not None]
+        if len(images) == 0:
+            self.logger.log_warn("閾値の自動調整に使える画像がありません")
+            return self._calibration_result(samples)
+
+        # 二値化の閾値: 全画像の輝度分布を紙とインクに分ける
+        gray_hist = np.zeros(256, dtype=np.int64)
+        for image in images:
+            gray_hist += np.bincount(image.ravel(), minlength=256)
+        self.gray_threshold = int(otsu_threshold(gray_hist))
+
+        # マーカー点の認識閾値: 各画像の３番目に強い反応 (＝マーカー点) と
+        # ４番目に強い反応 (＝マーカー以外) の間を取る
+        marker_peaks = []
+        for image in images:
+            _, image = cv2.threshold(
+                image,
+                self.gray_threshold,
+                255,
+                cv2.THRESH_BINARY
+            )
+            res = cv2.matchTemplate(image, self.marker, cv2.TM_CCOEFF_NORMED)
+            marker_peaks.append(self._find_peaks(res, 4))
+        marker_peaks = np.asarray(marker_peaks)
+        min_marker = np.min(marker_peaks[:, 2])
+        max_other = np.max(marker_peaks[:, 3])
+        if min_marker > max_other:
+            self.marker_threshold = float((min_marker + max_other) / 2)
+        else:
+            self.logger.log_warn(
+                "マーカー点とそれ以外の反応を分離できないため、マーカー点の認識閾値は変更しません" +
+                f" :marker={min_marker} :other={max_other}"
+            )
+        del images
+
+        # 塗りつぶしの最小割合: 各セルの塗りつぶし割合の分布を空欄と記入欄に分けた上で、
+        # 薄い記入も拾えるように空欄側のばらつきのすぐ上に置く
+        rows = sorted(
+            {0} | {row for rows in self.p_question_indices for row in rows}
+        )
+        area_rates = []
+        for filename in samples:
+            image = self.load_marksheet(filename)
+            if image is not None:
+                area_rates.append(
+                    self.compute_area_rates(image)[rows].ravel()
+                )
+        if len(area_rates) > 0:
+            area_rates = np.concatenate(area_rates)
+            split = otsu_threshold(
+                np.bincount(
+                    np.round(area_rates * 100).astype(np.int64),
+                    minlength=101
+                )
+            ) / 100
+
+            # 枠線だけが写った空欄の割合の中央値から、外れ値に強い尺度 (MAD) で上限を見積もる
+            blank_rates = area_rates[(0 < area_rates) & (area_rates <= split)]
+            if len(blank_rates) > 0:
+                median = np.median(blank_rates)
+                mad = np.median(np.abs(blank_rates - median))
+                split = min(split, median + 6 * 1.4826 * mad)
+            self.result_threshold_minrate = float(split)
+
+        return self._calibration_result(samples)
+
+    def _find_peaks(self, res: np.ndarray, n_peak: int) -> List[float]:
+        """テンプレートマッチングの結果から、マーカー１つ分以上離れた反応の強い順に値を取り出します。
+
+        Arguments:
+            res {np.ndarray} -- cv2.matchTemplate の結果
+            n_peak {int} -- 取り出す数
+        Returns:
+            List[float] -- 反応の強さの降順リスト
+        """
+        res = res.copy()
+        height, width = self.marker.shape
+        peaks = []
+        for _ in range(n_peak):
+            y, x = np.unravel_index(np.argmax(res), res.shape)
+            peaks.append(float(res[y, x]))
+            res[
+                max(0, y - height): y + height + 1,
+                max(0, x - width): x + width + 1
+            ] = -1
+        return peaks
+
+    def _calibration_result(self, samples: List[str]) -> Dict:
+        """閾値の自動調整の結果を辞書にまとめてログに出力します。
+
+        Arguments:
+            samples {List[str]} -- 抽出したファイル名のリスト
+        Returns:
+            Dict -- 決めた閾値と抽出したファイル名
+        """
+        result = {
+            "sample_files": [os.path.basename(x) for x in samples],
+            "marker_threshold": self.marker_threshold,
+            "gray_threshold": self.gray_threshold,
+            "result_threshold_minrate": self.result_threshold_minrate,
+        }
+        self.logger.log_info(
+            "閾値の自動調整結果" +
+            f" :marker_threshold={result['marker_threshold']}" +
+            f" :gray_threshold={result['gray_threshold']}" +
+            f" :result_threshold_minrate={result['result_threshold_minrate']}"
+        )
+        return result
+
     def get_answer(self, result):
         """塗りつぶしのデータから、回答を取り出します。
 
@@ -297,3 +580,117 @@ class MarksheetReader():
         data = np.where(result == 1)[0] + 1
         data = data.astype(np.uint8)
         return data
+
+
+def otsu_threshold(hist: np.ndarray) -> float:
+    """ヒストグラムを２つのクラスに分けるときの閾値を、大津の手法で求めます。
+    クラス間分散が最大となる閾値が幅を持つ場合 (２つの山の間に度数０の谷がある場合) は、その中央を返します。
+
+    Arguments:
+        hist {np.ndarray} -- 各ビンの度数
+    Returns:
+        float -- 閾値となるビン番号。これより大きいビンが上側のクラスとなる
+    """
+    hist = np.asarray(hist, dtype=np.float64)
+    bins = np.arange(len(hist))
+
+    # 閾値ごとの下側クラスの度数・平均値の累積
+    weight_low = np.cumsum(hist)
+    weight_high = weight_low[-1] - weight_low
+    sum_low = np.cumsum(hist * bins)
+    sum_high = sum_low[-1] - sum_low
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_low = sum_low / weight_low
+        mean_high = sum_high / weight_high
+        variance = weight_low * weight_high * (mean_low - mean_high) ** 2
+    variance = np.nan_to_num(variance)
+
+    best = np.flatnonzero(variance >= np.max(variance) * (1 - 1e-9))
+    return (best[0] + best[-1]) / 2
+
+
+def parse_pgm_header(header: bytes) -> Tuple[int, int, int, int]:
+    """バイナリー形式の PGM (P5) のヘッダーを解析します。
+
+    Arguments:
+        header {bytes} -- ファイルの先頭部分
+    Returns:
+        Tuple[int, int, int, int] --
+            int -- 幅
+            int -- 高さ
+            int -- 画素の最大値
+            int -- 画素データの開始位置
+    """
+    tokens = []
+    pos = 0
+    while len(tokens) < 4:
+        # 空白とコメントを読み飛ばす
+        while pos < len(header) and header[pos:pos + 1].isspace():
+            pos += 1
+        if header[pos:pos + 1] == b"#":
+            pos = header.find(b"\n", pos)
+            if pos < 0:
+                raise ValueError("PGM ヘッダーが不正です")
+            continue
+
+        start = pos
+        while pos < len(header) and not header[pos:pos + 1].isspace():
+            pos += 1
+        if start == pos or pos >= len(header):
+            raise ValueError("PGM ヘッダーが不正です")
+        tokens.append(header[start:pos])
+
+    if tokens[0] != b"P5":
+        raise ValueError("バイナリー形式の PGM (P5) ではありません")
+    width, height, maxval = [int(x) for x in tokens[1:]]
+    if width <= 0 or height <= 0 or not 0 < maxval < 65536:
+        raise ValueError("PGM ヘッダーが不正です")
+
+    # 最大値の直後の空白１文字の次から画素データが始まる
+    return width, height, maxval, pos + 1
+
+
+def pgm_dtype(maxval: int) -> Any:
+    """PGM の画素の最大値から、画素のデータ型を返します。
+
+    Arguments:
+        maxval {int} -- 画素の最大値
+    Returns:
+        Any -- 画素のデータ型 (16ビットはビッグエンディアン)
+    """
+    return np.dtype(np.uint8) if maxval < 256 else np.dtype(">u2")
+
+
+def to_uint8(image: np.ndarray, maxval: int) -> np.ndarray:
+    """画素の最大値が 255 でない画像を 0-255 の 8ビットに変換します。
+    最大値が 255 の場合はコピーせずにそのまま返します。
+
+    Arguments:
+        image {np.ndarray} -- グレースケール画像
+        maxval {int} -- 画素の最大値
+    Returns:
+        np.ndarray -- 8ビットのグレースケール画像
+    """
+    if maxval == 255:
+        return image
+    return (image.astype(np.uint32) * 255 // maxval).astype(np.uint8)
+
+
+def to_grayscale(image: np.ndarray) -> np.ndarray:
+    """8ビットのグレースケールまたは BGR の画像を、グレースケール画像にします。
+    それ以外のデータ型やチャンネル数の画像は、値の範囲を決められないため None を返します。
+    大きさが 0 の画像もマーカーを探せないため None を返します。
+
+    Arguments:
+        image {np.ndarray} -- 画像
+    Returns:
+        np.ndarray -- 8ビットのグレースケール画像
+    """
+    if image.dtype != np.uint8 or image.size == 0:
+        return None
+    if image.ndim == 2:
+        return image
+    if image.ndim == 3 and image.shape[2] == 3:
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return None
@@ -0,0 +1,202 @@
+# coding: utf-8
+###############################################################################
+#    読み取り処理の進捗と結果の統計を集計します。
+###############################################################################
+import os
+import json
+import time
+import pytz
+import heapq
+import threading
+from collections import Counter, deque
+from datetime import datetime as dt
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict
+
+# 独自モジュール
+from logger import Logger
+
+# 読み取り結果の段階 (MarksheetReader の読み込みエラー以外)
+STAGE_RECOGNIZED = "recognized"
+STAGE_PAGE_UNKNOWN = "page_number_unknown"
+STAGE_DUPLICATE_SKIPPED = "duplicate_skipped"
+
+# 読み取りに成功したとみなす段階
+SUCCESS_STAGES = (STAGE_RECOGNIZED, STAGE_DUPLICATE_SKIPPED)
+
+
+class RunStats():
+    """ページごとの読み取り結果を段階別に数え、処理速度と残り時間を直近の一定ページ数から求めます。
+    """
+
+    def __init__(self, n_total: int, window: int, n_slowest: int):
+        """コンストラクター
+
+        Arguments:
+            n_total {int} -- 読み取り対象の総ファイル数
+            window {int} -- 処理速度と失敗率を求める直近のページ数
+            n_slowest {int} -- 記録する処理時間の長いページの数
+        """
+        self.logger = Logger("RunStats")
+        self.n_total = n_total
+        self.n_slowest = n_slowest
+        self.counts = Counter()
+        self.started_at = dt.now(pytz.timezone("Asia/Tokyo"))
+        self._started = time.perf_counter()
+        self._finished = None
+
+        # 直近のページの (完了時刻, 成功したかどうか)
+        self._recent = deque(maxlen=window)
+
+        # 処理時間の長いページ (処理時間, ファイル名, 段階) の最小ヒープ
+        self._slowest = []
+
+        self._lock = threading.Lock()
+        self._server = None
+
+    def record(self, file_name: str, stage: str, elapsed: float):
+        """１ページ分の読み取り結果を記録します。
+
+        Arguments:
+            file_name {str} -- ファイル名
+            stage {str} -- 読み取り結果の段階
+            elapsed {float} -- このページの処理時間 (秒)
+        """
+        with self._lock:
+            self.counts[stage] += 1
+            self._recent.append(
+                (time.perf_counter(), stage in SUCCESS_STAGES)
+            )
+            item = (elapsed, file_name, stage)
+            if len(self._slowest) < self.n_slowest:
+                heapq.heappush(self._slowest, item)
+            elif self._slowest and item > self._slowest[0]:
+                heapq.heapreplace(self._slowest, item)
+
+    def finish(self):
+        """処理の終了時刻を記録し、統計の公開を終了します。
+        """
+        self._finished = time.perf_counter()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def snapshot(self) -> Dict:
+        """現時点の統計を辞書にまとめて返します。
+
+        Returns:
+            Dict -- 統計情報
+        """
+        with self._lock:
+            now = self._finished or time.perf_counter()
+            elapsed = now - self._started
+            n_processed = sum(self.counts.values())
+            recent = list(self._recent)
+            counts = dict(self.counts)
+            slowest = sorted(self._slowest, reverse=True)
+
+        # 直近の処理速度と失敗率
+        rolling_rate = None
+        rolling_failure_rate = None
+        if len(recent) >= 2 and recent[-1][0] > recent[0][0]:
+            rolling_rate = (len(recent) - 1) / (recent[-1][0] - recent[0][0])
+        if len(recent) > 0:
+            rolling_failure_rate = \
+                sum(not x[1] for x in recent) / len(recent)
+
+        # 残り時間は直近の処理速度から見積もる
+        eta = None
+        if rolling_rate:
+            eta = (self.n_total - n_processed) / rolling_rate
+
+        return {
+            "started_at": self.started_at.isoformat(timespec="seconds"),
+            "elapsed_sec": elapsed,
+            "total": self.n_total,
+            "processed": n_processed,
+            "counts": counts,
+            "pages_per_sec": n_processed / elapsed if elapsed > 0 else None,
+            "rolling_pages_per_sec": rolling_rate,
+            "rolling_failure_rate": rolling_failure_rate,
+            "eta_sec": eta,
+            "slowest_pages": [
+                {"file_name": x[1], "elapsed_sec": x[0], "stage": x[2]}
+                for x in slowest
+            ],
+        }
+
+    def to_text(self) -> str:
+        """現時点の統計を「項目名: 値」形式のテキストにして返します。
+
+        Returns:
+            str -- 統計情報のテキスト
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for key, value in snapshot.items():
+            if key == "counts":
+                for stage, count in sorted(value.items()):
+                    lines.append(f"counts.{stage}: {count}")
+            elif key == "slowest_pages":
+                for page in value:
+                    lines.append(
+                        f"slowest: {page['file_name']}" +
+                        f" {page['elapsed_sec']:.3f}s {page['stage']}"
+                    )
+            elif isinstance(value, float):
+                lines.append(f"{key}: {value:.3f}")
+            else:
+                lines.append(f"{key}: {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_report(self, summary_dir: str, extra: Dict = None):
+        """統計を run_report.json として書き出します。
+
+        Arguments:
+            summary_dir {str} -- 書き出し先のディレクトリー
+            extra {Dict} -- 統計に加えて書き出す情報
+        """
+        report = self.snapshot()
+        if extra is not None:
+            report.update(extra)
+
+        os.makedirs(summary_dir, exist_ok=True)
+        with open(
+                os.path.join(summary_dir, "run_report.json"), "w",
+                encoding="utf-8"
+        ) as f:
+            json.dump(report, f, ensure_ascii=False, indent=4)
+
+    def serve(self, port: int) -> int:
+        """現時点の統計をテキストで返す HTTP サーバーを、ローカルホストの別スレッドで起動します。
+
+        Arguments:
+            port {int} -- 待ち受けるポート番号。0 の場合は空いているポートを使う
+        Returns:
+            int -- 実際に待ち受けているポート番号
+        """
+        stats = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = stats.to_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                # アクセスごとのログは出力しない
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        threading.Thread(
+            target=self._server.serve_forever, daemon=True
+        ).start()
+        port = self._server.server_address[1]
+        self.logger.log_info(
+            f"統計情報を公開しました :url=http://127.0.0.1:{port}/"
+        )
+        return port
@@ -0,0 +1,134 @@
+# coding: utf-8
+###############################################################################
+#    プロセス間で画像をコピーせずに受け渡すための共有メモリーのリングバッファーです。
+###############################################################################
+import numpy as np
+import os
+import multiprocessing
+from multiprocessing import shared_memory
+from typing import Any, Tuple
+
+
+class SharedPageRing():
+    """同じサイズの画像を格納するスロットを共有メモリー上に並べたリングバッファーです。
+    書き込み側は acquire で空きスロットを取得して view に直接書き込み、publish で受け渡します。
+    読み込み側は get で受け取ったスロットを view で参照し、使い終わったら release で返却します。
+    空きスロットがなくなると acquire がブロックするため、書き込み側が先行しすぎることはありません。
+    """
+
+    def __init__(self, n_slot: int, shape: Tuple, dtype: Any = np.uint8):
+        """コンストラクター
+
+        Arguments:
+            n_slot {int} -- スロット数
+            shape {Tuple} -- １スロットに格納する画像の形状
+            dtype {Any} -- 画像のデータ型
+        """
+        self.n_slot = n_slot
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.slot_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+
+        # 全スロット分の共有メモリーを確保する
+        self._shm = shared_memory.SharedMemory(
+            create=True, size=self.slot_bytes * n_slot
+        )
+        self._owner_pid = os.getpid()
+
+        # 空きスロット番号のキューと、書き込み済みスロットのキュー
+        self._free_slots = multiprocessing.Queue()
+        self._filled_slots = multiprocessing.Queue()
+        for slot in range(n_slot):
+            self._free_slots.put(slot)
+
+    def __getstate__(self):
+        """子プロセスに渡すときは共有メモリーの名前だけを引き継ぎます。
+        """
+        state = self.__dict__.copy()
+        state["_shm_name"] = self._shm.name
+        del state["_shm"]
+        return state
+
+    def __setstate__(self, state: dict):
+        """子プロセス側で共有メモリーに接続します。
+        """
+        shm_name = state.pop("_shm_name")
+        self.__dict__.update(state)
+        self._shm = shared_memory.SharedMemory(name=shm_name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def acquire(self, timeout: float = None) -> int:
+        """空きスロットを取得します。空きがない場合は返却されるまで待機します。
+
+        Arguments:
+            timeout {float} -- 待機する最大秒数。None の場合は無制限
+        Returns:
+            int -- スロット番号
+        """
+        return self._free_slots.get(timeout=timeout)
+
+    def view(self, slot: int) -> np.ndarray:
+        """スロットの内容をコピーせずに参照する配列を返します。
+
+        Arguments:
+            slot {int} -- スロット番号
+        Returns:
+            np.ndarray -- 共有メモリー上の配列
+        """
+        return np.ndarray(
+            self.shape,
+            dtype=self.dtype,
+            buffer=self._shm.buf,
+            offset=slot * self.slot_bytes
+        )
+
+    def publish(self, slot: int, item: Any = None):
+        """書き込み済みのスロットを読み込み側に受け渡します。
+        画像を伴わない通知 (読み込みエラーや終了の合図など) は slot に None を指定します。
+
+        Arguments:
+            slot {int} -- スロット番号
+            item {Any} -- スロットに付随させる情報 (pickle 可能なもの)
+        """
+        self._filled_slots.put((slot, item))
+
+    def get(self, timeout: float = None) -> Tuple[int, Any]:
+        """書き込み済みのスロットを受け取ります。届くまで待機します。
+
+        Arguments:
+            timeout {float} -- 待機する最大秒数。None の場合は無制限
+        Returns:
+            Tuple[int, Any] --
+                int -- スロット番号。画像を伴わない通知の場合は None
+                Any -- publish で指定した情報
+        """
+        return self._filled_slots.get(timeout=timeout)
+
+    def release(self, slot: int):
+        """読み終わったスロットを空きスロットに戻します。
+        これ以降、このスロットの view は書き換えられる可能性があります。
+
+        Arguments:
+            slot {int} -- スロット番号
+        """
+        if slot is not None:
+            self._free_slots.put(slot)
+
+    def close(self):
+        """共有メモリーとの接続を閉じます。生成したプロセスでは共有メモリーを破棄します。
+        view で取得した配列はこれより前に破棄しておく必要があります。
+        """
+        try:
+            self._shm.close()
+        except BufferError:
+            # 例外の traceback などが view を参照したままの場合は閉じられないが、
+            # 本来の例外を隠さないようにする (マッピングはプロセス終了時に解放される)
+            pass
+        if os.getpid() == self._owner_pid:
+            # fork で引き継いだ場合も含め、生成したプロセスだけが破棄する
+            self._shm.unlink()
@@ -0,0 +1,243 @@
+# coding: utf-8
+###############################################################################
+#    性能の退行を検出するベンチマークです。
+#    1ページあたりの処理時間とメモリー使用量の最大値を計測し、
+#    benchmark_baseline.json に記録した基準値から一定の割合を超えて悪化した場合に失敗します。
+#    処理時間は、同じ実行中に交互に計測した基準処理の時間に対する比率で比較します。
+#    実行環境の負荷で結果が揺らぐため、環境変数 RUN_BENCHMARKS=1 を指定した場合だけ実行します。
+#    基準値は requirements.txt のバージョン (Dockerfile と同じ Python 3.8) で記録しています。
+#    ライブラリーのマイナーバージョン以上が基準値の記録時と異なる環境では比較しません。
+#    意図して性能が変わる変更をした場合やライブラリーを更新した場合は、
+#    環境変数 UPDATE_BENCHMARK_BASELINE=1 を指定して実行し、基準値を記録し直して下さい。
+###############################################################################
+from unittest import TestCase, mock, skipUnless
+import os
+import sys
+import json
+import time
+import statistics
+import platform
+import tracemalloc
+import numpy as np
+import pandas as pd
+import cv2
+from typing import Callable, Dict
+from duplicate_detector import DuplicateDetector
+from test_marksheet_reader import SAMPLE_PATHS
+
+# main はインポート時にコマンドライン引数を解析するため、pytest の引数を渡さないようにする
+with mock.patch.object(sys, "argv", ["main.py"]):
+    import main
+
+# 基準値の保存先
+BASELINE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json"
+)
+
+# ベンチマークを実行するかどうか、基準値を記録し直すかどうか
+UPDATE_BASELINE = os.environ.get("UPDATE_BENCHMARK_BASELINE") == "1"
+RUN_BENCHMARKS = os.environ.get("RUN_BENCHMARKS") == "1" or UPDATE_BASELINE
+
+# 基準値から悪化を許容する割合
+# 処理時間の比率は、1CPU の環境で 6回実行したときの最大値と最小値の比が 1.13-1.22 倍でした
+# 揺らぎで失敗せず、1.5倍の悪化は検出できるように 0.5 としています
+LATENCY_TOLERANCE = 0.5
+MEMORY_TOLERANCE = 0.2
+
+# 処理時間を計測する回数 (基準処理と交互に計測した比率の中央値を取る)
+N_REPEAT = 9
+
+# 1回の計測で処理するページ数
+# 1ページ数ミリ秒の処理は揺らぎに埋もれるため、まとめて計測して1回あたり 0.1秒以上にする
+N_PAGE = 64
+N_LOAD_PAGE = 8
+
+# 基準処理に使う画像 (スキャン画像と同じサイズ)
+REFERENCE_IMAGE = np.random.RandomState(0).randint(
+    0, 256, (2344, 1654), dtype=np.uint8
+)
+
+
+def elapsed(func: Callable) -> float:
+    """処理を実行し、かかった時間 (秒) を返します。
+    """
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def measure_latency_ratio(func: Callable, n_page: int) -> float:
+    """基準処理と n_page ページ分の処理を交互に繰り返し実行し、
+    1ページあたりの処理時間の基準処理に対する比率の中央値を返します。
+    直前に計測した基準処理と比べることで、実行環境の負荷の変化が比率の分子と分母に同じように表れます。
+    """
+    func()
+    reference_workload()
+    ratios = []
+    for _ in range(N_REPEAT):
+        reference_sec = elapsed(reference_workload) / N_LOAD_PAGE
+        ratios.append(elapsed(func) / n_page / reference_sec)
+    return statistics.median(ratios)
+
+
+def reference_workload():
+    """処理時間の比率の分母とする基準処理です。マークシートの読み込みに近い画像処理を N_LOAD_PAGE ページ分行います。
+    """
+    for _ in range(N_LOAD_PAGE):
+        image = cv2.GaussianBlur(REFERENCE_IMAGE, (5, 5), 0)
+        _, image = cv2.threshold(image, 120, 255, cv2.THRESH_BINARY)
+        cv2.resize(image, (600, 3600))
+
+
+def library_versions() -> Dict:
+    """計測結果に影響するライブラリーのバージョンを返します。
+    """
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "pandas": pd.__version__,
+    }
+
+
+def release_series(versions: Dict) -> Dict:
+    """ライブラリーのバージョンから、性能が変わりうるマイナーバージョンまでを取り出します。
+    """
+    return {
+        name: ".".join(version.split(".")[:2])
+        for name, version in versions.items()
+    }
+
+
+def measure_memory(func: Callable) -> int:
+    """処理を実行し、その間に確保されたメモリーの最大値 (バイト) を返します。
+    """
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+@skipUnless(RUN_BENCHMARKS, "RUN_BENCHMARKS=1 を指定した場合だけ実行します")
+class TestBenchmark(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.baseline = {"versions": {}, "values": {}}
+        if os.path.isfile(BASELINE_PATH):
+            with open(BASELINE_PATH, encoding="utf-8") as f:
+                cls.baseline = json.load(f)
+        cls.measured = {}
+
+        # OpenCV の並列処理はほかのプロセスの負荷で揺らぐため、1スレッドで計測する
+        cls.n_thread = cv2.getNumThreads()
+        cv2.setNumThreads(1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cv2.setNumThreads(cls.n_thread)
+        if UPDATE_BASELINE:
+            baseline = {
+                "versions": library_versions(),
+                "values": {**cls.baseline["values"], **cls.measured},
+            }
+            with open(BASELINE_PATH, "w", encoding="utf-8") as f:
+                json.dump(baseline, f, indent=4, sort_keys=True)
+                f.write("\n")
+
+    def setUp(self):
+        self.reader = main.MarksheetReader(0.5, False)
+        self.images = [self.reader.load_marksheet(x) for x in SAMPLE_PATHS]
+
+        # 1回の計測で処理するページ (サンプル画像を繰り返す)
+        n_repeat = N_PAGE // len(SAMPLE_PATHS)
+        self.pages = self.images * n_repeat
+        self.page_paths = SAMPLE_PATHS * n_repeat
+
+    def assert_baseline(self, name: str, value: float, tolerance: float):
+        """計測値が基準値から許容範囲内であること
+        """
+        self.measured[name] = value
+        if UPDATE_BASELINE:
+            return
+        if name not in self.baseline["values"]:
+            self.skipTest(f"基準値が記録されていません :name={name}")
+        if release_series(self.baseline["versions"]) != \
+                release_series(library_versions()):
+            self.skipTest(
+                "ライブラリーのマイナーバージョンが基準値の記録時と異なります" +
+                f" :baseline={self.baseline['versions']}" +
+                f" :current={library_versions()}"
+            )
+
+        expected = self.baseline["values"][name]
+        self.assertLessEqual(
+            value, expected * (1 + tolerance),
+            f"{name} が基準値 {expected} から" +
+            f" {tolerance:.0%} を超えて悪化しました :measured={value}"
+        )
+
+    def assert_latency(self, name: str, func: Callable, n_page: int):
+        """1ページあたりの処理時間の、基準処理に対する比率が許容範囲内であること
+        """
+        self.assert_baseline(
+            name, measure_latency_ratio(func, n_page), LATENCY_TOLERANCE
+        )
+
+    def test_load_marksheet_latency(self):
+        """画像の読み込みと整形にかかる1ページあたりの時間
+        """
+        paths = self.page_paths[:N_LOAD_PAGE]
+        self.assert_latency(
+            "load_marksheet",
+            lambda: [self.reader.load_marksheet(x) for x in paths],
+            len(paths)
+        )
+
+    def test_recognize_marksheet_latency(self):
+        """マークの認識にかかる1ページあたりの時間
+        """
+        self.assert_latency(
+            "recognize_marksheet",
+            lambda: [
+                self.reader.recognize_marksheet(image, path)
+                for image, path in zip(self.pages, self.page_paths)
+            ],
+            len(self.pages)
+        )
+
+    def test_summarize_latency(self):
+        """認識結果の集計までを含めた1ページあたりの時間
+        """
+        def summarize():
+            n_page, answers, answer_tables, data_sums = \
+                main.init_answer_columns(self.reader)
+            multi_ans, no_ans, no_recognize, duplicates = \
+                main.init_warning_results()
+            self.reader.duplicate_detector = DuplicateDetector(
+                self.reader.duplicate_max_distance,
+                self.reader.duplicate_detector.hash_bits
+            )
+            for i, image in enumerate(self.pages):
+                multi_ans, no_ans, no_recognize, duplicates = \
+                    main.summarize_image(
+                        self.reader, f"{i}.jpg", image, answers,
+                        data_sums, multi_ans, no_ans, no_recognize,
+                        duplicates, answer_tables, digest=f"{i}"
+                    )
+
+        self.assert_latency("summarize", summarize, len(self.pages))
+
+    def test_memory(self):
+        """1ページの読み込みから認識までに確保されるメモリーの最大値
+        """
+        def process():
+            image = self.reader.load_marksheet(SAMPLE_PATHS[0])
+            self.reader.recognize_marksheet(image, SAMPLE_PATHS[0])
+
+        self.assert_baseline(
+            "process_peak_bytes", measure_memory(process), MEMORY_TOLERANCE
+        )
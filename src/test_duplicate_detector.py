@@ -0,0 +1,195 @@
+# coding: utf-8
+###############################################################################
+#    単体テストケース
+###############################################################################
+from unittest import TestCase
+import os
+import tempfile
+import numpy as np
+import cv2
+from marksheet_reader import MarksheetReader
+from marksheet_fixture import make_marksheet_image
+from duplicate_detector import (
+    DuplicateDetector, compute_page_hash, file_digest
+)
+from test_marksheet_reader import SAMPLE_PATHS, SYNTHETIC_ANSWERS
+
+
+def rotate(image: np.ndarray, angle: float) -> np.ndarray:
+    """用紙を傾けて読み直した画像を模して、画像を回転させます。
+    """
+    height, width = image.shape
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1)
+    return cv2.warpAffine(image, matrix, (width, height), borderValue=255)
+
+
+class TestDuplicateDetector(TestCase):
+
+    def test_compute_page_hash(self):
+        """塗りつぶし割合の段階ごとにビットを立て、マークの増減で段階の数だけビットが変わること
+        """
+        fill_levels = [0.2, 0.3]
+        area_rates = np.zeros((3, 2))
+        area_rates[0, 0] = 0.4
+        area_rates[1, 1] = 0.25
+
+        # セルごとに段階の数だけ、先頭のセルから上位ビットに並ぶ
+        self.assertEqual(
+            compute_page_hash(area_rates, fill_levels),
+            int("11" "00" "00" "10" "00" "00" "0000", 2)
+        )
+
+        # 少しの変化では変わらない
+        self.assertEqual(
+            compute_page_hash(area_rates + 0.02, fill_levels),
+            compute_page_hash(area_rates, fill_levels)
+        )
+
+        # マークの増減は段階の数だけ変わる
+        other = area_rates.copy()
+        other[2, 0] = 0.4
+        self.assertEqual(
+            bin(
+                compute_page_hash(area_rates, fill_levels) ^
+                compute_page_hash(other, fill_levels)
+            ).count("1"),
+            len(fill_levels)
+        )
+
+    def test_check(self):
+        """ハミング距離が上限以下で同じページ番号のものを重複の疑いとし、登録もすること
+        """
+        detector = DuplicateDetector(3, 64)
+        page_hash = 0x0123456789abcdef
+
+        self.assertEqual(
+            detector.check(1, page_hash, "a.jpg", "A"), (None, None, False)
+        )
+        self.assertEqual(
+            detector.check(1, page_hash ^ 0b10101, "b.jpg", "B"),
+            ("a.jpg", 3, False)
+        )
+        self.assertEqual(
+            detector.check(1, page_hash ^ 0b11110, "c.jpg", "C"),
+            ("b.jpg", 3, False)
+        )
+        self.assertEqual(
+            detector.check(2, page_hash, "d.jpg", "D"), (None, None, False)
+        )
+        self.assertEqual(len(detector.entries), 4)
+
+    def test_check_exact(self):
+        """ファイルの内容が同じ場合だけを同じファイルの重複とし、ファイル名も同じ場合は読み直しとすること
+        """
+        detector = DuplicateDetector(3, 64)
+        page_hash = 0x0123456789abcdef
+
+        self.assertEqual(
+            detector.check(1, page_hash, "a.jpg", "A"), (None, None, False)
+        )
+        self.assertEqual(
+            detector.check(1, page_hash, "copy.jpg", "A"), ("a.jpg", 0, True)
+        )
+        self.assertEqual(
+            detector.check(1, page_hash, "a.jpg", "A"), (None, None, False)
+        )
+        self.assertEqual(len(detector.entries), 1)
+
+        # 同じファイル名でも内容が異なれば別の用紙として扱う
+        self.assertEqual(
+            detector.check(1, page_hash, "a.jpg", "B"), ("a.jpg", 0, False)
+        )
+        self.assertEqual(
+            detector.check(1, page_hash, "copy.jpg", "B"), ("a.jpg", 0, True)
+        )
+        self.assertEqual(len(detector.entries), 2)
+
+        # ダイジェストがない場合は内容の一致を調べない
+        self.assertEqual(
+            detector.check(2, page_hash, "x.jpg", None), (None, None, False)
+        )
+        self.assertEqual(
+            detector.check(2, page_hash, "x.jpg", None), ("x.jpg", 0, False)
+        )
+
+    def test_save(self):
+        """保存した索引を読み込んで、前回の実行分とも比較できること
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            index_path = os.path.join(temp_dir, "index.json")
+            detector = DuplicateDetector(3, 64, index_path)
+            detector.check(1, 12345, "a.jpg", "A")
+            detector.save()
+
+            detector = DuplicateDetector(3, 64, index_path)
+            self.assertEqual(
+                detector.check(1, 12345, "a.jpg", "A"), (None, None, False)
+            )
+            self.assertEqual(
+                detector.check(1, 12345, "b.jpg", "A"), ("a.jpg", 0, True)
+            )
+            self.assertEqual(
+                detector.check(1, 12345, "c.jpg", "C"), ("a.jpg", 0, False)
+            )
+
+            # ハッシュ値のビット数が異なる索引は読み込まない
+            detector = DuplicateDetector(3, 128, index_path)
+            self.assertEqual(
+                detector.check(1, 12345, "b.jpg", "A"), (None, None, False)
+            )
+
+    def test_file_digest(self):
+        """ファイルの内容が同じ場合だけダイジェストが一致すること
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            paths = [os.path.join(temp_dir, x) for x in ["a", "b", "c"]]
+            for path, data in zip(paths, [b"page", b"page", b"other"]):
+                with open(path, "wb") as f:
+                    f.write(data)
+            digests = [file_digest(x) for x in paths]
+            self.assertEqual(digests[0], digests[1])
+            self.assertNotEqual(digests[0], digests[2])
+
+    def test_page_hash_distance(self):
+        """傾けて読み直したページは重複と判定し、回答が１つ異なるページは重複と判定しないこと
+        """
+        reader = MarksheetReader(0.5, False)
+
+        def page_hash(image: np.ndarray) -> int:
+            return compute_page_hash(
+                reader.compute_area_rates(
+                    reader.load_marksheet("scan.png", image)
+                ),
+                reader.duplicate_fill_levels
+            )
+
+        def distance(a: int, b: int) -> int:
+            return bin(a ^ b).count("1")
+
+        for path in SAMPLE_PATHS:
+            image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+            for angle in [0.4, -0.7, 1.0]:
+                with self.subTest(path=path, angle=angle):
+                    rotated = page_hash(rotate(image, angle))
+                    self.assertLessEqual(
+                        distance(page_hash(image), rotated),
+                        reader.duplicate_max_distance
+                    )
+
+        for page_number, answers in SYNTHETIC_ANSWERS:
+            base = page_hash(
+                make_marksheet_image(reader, page_number, answers)
+            )
+            for question in range(len(answers)):
+                changed = [list(x) for x in answers]
+                changed[question] = [2] if changed[question] == [1] else [1]
+                with self.subTest(page_number=page_number, question=question):
+                    self.assertGreater(
+                        distance(
+                            base,
+                            page_hash(make_marksheet_image(
+                                reader, page_number, changed
+                            ))
+                        ),
+                        reader.duplicate_max_distance
+                    )
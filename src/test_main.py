@@ -0,0 +1,315 @@
+# coding: utf-8
+###############################################################################
+#    単体テストケース
+###############################################################################
+from unittest import TestCase, mock
+import os
+import sys
+import json
+import shutil
+import tempfile
+import multiprocessing
+import pandas as pd
+import cv2
+from marksheet_fixture import make_marksheet_image
+from duplicate_detector import DuplicateDetector
+from test_marksheet_reader import (
+    SAMPLE_PATHS, SAMPLE_EXPECTED, SYNTHETIC_ANSWERS
+)
+
+# main はインポート時にコマンドライン引数を解析するため、pytest の引数を渡さないようにする
+with mock.patch.object(sys, "argv", ["main.py"]):
+    import main
+
+
+def crash_worker(ring, reader, file_names):
+    """終了の合図を送らずに異常終了する子プロセスです。
+    """
+    os._exit(1)
+
+
+class TestMain(TestCase):
+
+    def setUp(self):
+        self.reader = main.MarksheetReader(0.5, False)
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.img_dir = os.path.join(self.temp_dir.name, "img")
+        self.reader.summary_dir = os.path.join(self.temp_dir.name, "summary")
+        os.mkdir(self.img_dir)
+
+        # ファイル名順に読み込むので、先頭の文字で順序を決めておく
+        shutil.copy(SAMPLE_PATHS[0], os.path.join(self.img_dir, "a-01.jpg"))
+        shutil.copy(SAMPLE_PATHS[1], os.path.join(self.img_dir, "b-02.jpg"))
+        for page_number, answers in SYNTHETIC_ANSWERS:
+            cv2.imwrite(
+                os.path.join(self.img_dir, f"c-synthetic-p{page_number}.png"),
+                make_marksheet_image(self.reader, page_number, answers)
+            )
+        shutil.copy(SAMPLE_PATHS[0], os.path.join(self.img_dir, "d-copy.jpg"))
+        with open(os.path.join(self.img_dir, "e-broken.jpg"), "wb") as f:
+            f.write(b"not an image")
+        open(os.path.join(self.img_dir, "f-notes.txt"), "w").close()
+        self.files = sorted(os.listdir(self.img_dir))
+
+        self.options = mock.patch.multiple(
+            main.COMMANDLINE_OPTIONS,
+            imgdir=self.img_dir,
+            workers=0,
+            skip_duplicates=False
+        )
+        self.options.start()
+
+    def tearDown(self):
+        self.options.stop()
+        self.temp_dir.cleanup()
+
+    def run_pipeline(self):
+        """読み取りから CSV 出力までを実行します。
+        """
+        n_page, answers, answer_tables, data_sums = \
+            main.init_answer_columns(self.reader)
+        multi_ans, no_ans, no_recognize, duplicates = \
+            main.init_warning_results()
+        stats = main.RunStats(len(self.files), 50, 3)
+
+        if main.COMMANDLINE_OPTIONS.workers > 0:
+            multi_ans, no_ans, no_recognize, duplicates = \
+                main.process_summarize_parallel(
+                    self.reader, self.files, answers,
+                    data_sums, multi_ans, no_ans,
+                    no_recognize, duplicates, answer_tables, stats
+                )
+        else:
+            for file in self.files:
+                multi_ans, no_ans, no_recognize, duplicates = \
+                    main.process_summarize(
+                        self.reader, file, answers,
+                        data_sums, multi_ans, no_ans,
+                        no_recognize, duplicates, answer_tables, stats
+                    )
+        stats.finish()
+
+        main.print_summary(
+            self.reader, n_page, answers, data_sums, multi_ans, no_ans,
+            no_recognize, duplicates, answer_tables, stats
+        )
+
+    def read_csv(self, name: str) -> pd.DataFrame:
+        """出力された CSV を読み込みます。
+        """
+        return pd.read_csv(
+            os.path.join(self.reader.summary_dir, name), encoding="sjis"
+        )
+
+    def expected_pages(self, include_copy: bool):
+        """読み込んだページの正しい読み取り結果を、読み込み順に返します。
+        """
+        pages = [SAMPLE_EXPECTED[0], SAMPLE_EXPECTED[1]] + SYNTHETIC_ANSWERS
+        if include_copy:
+            pages.append(SAMPLE_EXPECTED[0])
+        return pages
+
+    def assert_aggregates(self, pages):
+        """集計 CSV が単一回答の件数と一致すること
+        """
+        for page_index in range(len(self.reader.p_question_indices)):
+            n_question = len(self.reader.p_question_indices[page_index])
+            expected = [[0] * self.reader.n_col for _ in range(n_question)]
+            for page_number, answers in pages:
+                if page_number != page_index + 1:
+                    continue
+                for question, answer in enumerate(answers):
+                    if len(answer) == 1:
+                        expected[question][answer[0] - 1] += 1
+
+            aggregates = self.read_csv(f"aggregates-p{page_index + 1}.csv")
+            self.assertEqual(
+                list(aggregates["Q-No."]),
+                [f"Q-{x + 1}" for x in range(n_question)]
+            )
+            self.assertEqual(
+                aggregates.drop(columns="Q-No.").values.tolist(), expected
+            )
+
+    def test_summarize(self):
+        """読み取り結果が各 CSV に正しく集計されること
+        """
+        self.run_pipeline()
+        pages = self.expected_pages(include_copy=True)
+        self.assert_aggregates(pages)
+
+        # 個人単位の読み取り結果
+        for page_index in range(len(self.reader.p_question_indices)):
+            answer_table = self.read_csv(f"answers-p{page_index + 1}.csv")
+            expected = [
+                [question + 1] + [
+                    (col + 1) in answer for col in range(self.reader.n_col)
+                ]
+                for page_number, answers in pages
+                if page_number == page_index + 1
+                for question, answer in enumerate(answers)
+            ]
+            self.assertEqual(
+                answer_table.drop(columns=["ファイル名", "ページ番号"])
+                .values.tolist(),
+                expected
+            )
+
+        # 複数回答・無回答
+        self.assertEqual(
+            len(self.read_csv("multiple_answers.csv")),
+            sum(len(x) > 1 for _, answers in pages for x in answers)
+        )
+        self.assertEqual(
+            len(self.read_csv("nothing_answers.csv")),
+            sum(len(x) == 0 for _, answers in pages for x in answers)
+        )
+
+        # 読み取りエラー・重複スキャン
+        self.assertEqual(
+            list(self.read_csv("no_recognized.csv")["ファイル名"]),
+            ["e-broken.jpg", "f-notes.txt"]
+        )
+        duplicates = self.read_csv("duplicates.csv")
+        self.assertEqual(list(duplicates["ファイル名"]), ["d-copy.jpg"])
+        self.assertEqual(list(duplicates["重複元ファイル名"]), ["a-01.jpg"])
+        self.assertEqual(list(duplicates["同一ファイル"]), [True])
+
+        # 実行レポート
+        with open(
+                os.path.join(self.reader.summary_dir, "run_report.json"),
+                encoding="utf-8"
+        ) as f:
+            report = json.load(f)
+        self.assertEqual(
+            report["counts"],
+            {
+                "recognized": 5,
+                "imread_failed": 1,
+                "unsupported_extension": 1,
+            }
+        )
+        self.assertEqual(report["duplicates"], 1)
+
+    def test_skip_duplicates(self):
+        """内容がまったく同じファイルだけを集計から除外し、読み直した別のファイルは疑いとして報告するだけにすること
+        """
+        # 読み直した画像は、回答が同じ別の用紙と区別できないので除外しない
+        cv2.imwrite(
+            os.path.join(self.img_dir, "g-rescan.png"),
+            cv2.imread(SAMPLE_PATHS[0], cv2.IMREAD_GRAYSCALE)
+        )
+        self.files = sorted(os.listdir(self.img_dir))
+
+        main.COMMANDLINE_OPTIONS.skip_duplicates = True
+        self.run_pipeline()
+        self.assert_aggregates(
+            self.expected_pages(include_copy=False) + [SAMPLE_EXPECTED[0]]
+        )
+        duplicates = self.read_csv("duplicates.csv")
+        self.assertEqual(
+            list(duplicates["ファイル名"]), ["d-copy.jpg", "g-rescan.png"]
+        )
+        self.assertEqual(list(duplicates["同一ファイル"]), [True, False])
+        with open(
+                os.path.join(self.reader.summary_dir, "run_report.json"),
+                encoding="utf-8"
+        ) as f:
+            self.assertEqual(json.load(f)["counts"]["duplicate_skipped"], 1)
+
+    def use_index(self, index_path: str):
+        """索引を保存するファイル名を指定して、重複検出の索引を作り直します。
+        """
+        self.reader.duplicate_detector = DuplicateDetector(
+            self.reader.duplicate_max_distance,
+            self.reader.duplicate_detector.hash_bits,
+            index_path
+        )
+
+    def test_rerun_with_index(self):
+        """索引を保存して同じディレクトリーを読み直しても、読み直したページを重複としないこと
+        """
+        main.COMMANDLINE_OPTIONS.skip_duplicates = True
+        index_path = os.path.join(self.temp_dir.name, "index.json")
+        for _ in range(2):
+            self.use_index(index_path)
+            self.run_pipeline()
+            self.reader.duplicate_detector.save()
+
+            self.assert_aggregates(self.expected_pages(include_copy=False))
+            self.assertEqual(
+                list(self.read_csv("duplicates.csv")["ファイル名"]),
+                ["d-copy.jpg"]
+            )
+
+    def test_batches_with_same_names(self):
+        """ファイル名が前回の実行分と同じでも、内容が異なれば別のページとして扱うこと
+        """
+        main.COMMANDLINE_OPTIONS.skip_duplicates = True
+        index_path = os.path.join(self.temp_dir.name, "index.json")
+        self.use_index(index_path)
+        self.run_pipeline()
+        self.reader.duplicate_detector.save()
+
+        # 前回と同じファイル名で、中身の異なる画像と前回の画像のコピーを読み込む
+        batch_dir = os.path.join(self.temp_dir.name, "batch2")
+        os.mkdir(batch_dir)
+        cv2.imwrite(
+            os.path.join(batch_dir, "a-01.jpg"),
+            cv2.imread(SAMPLE_PATHS[1], cv2.IMREAD_GRAYSCALE)
+        )
+        shutil.copy(SAMPLE_PATHS[0], os.path.join(batch_dir, "b-02.jpg"))
+        main.COMMANDLINE_OPTIONS.imgdir = batch_dir
+        self.files = sorted(os.listdir(batch_dir))
+
+        self.use_index(index_path)
+        self.run_pipeline()
+
+        # a-01.jpg は前回の b-02.jpg と回答が同じなので疑いとして報告するだけで集計し、
+        # b-02.jpg は前回の a-01.jpg と内容が同じなので除外する
+        self.assert_aggregates([SAMPLE_EXPECTED[1]])
+        duplicates = self.read_csv("duplicates.csv")
+        self.assertEqual(
+            duplicates[["ファイル名", "重複元ファイル名", "同一ファイル"]]
+            .values.tolist(),
+            [["a-01.jpg", "b-02.jpg", False], ["b-02.jpg", "a-01.jpg", True]]
+        )
+
+    def test_summarize_parallel(self):
+        """並列で読み込んでも同じ集計結果になること
+        """
+        main.COMMANDLINE_OPTIONS.workers = 2
+        self.run_pipeline()
+        self.assert_aggregates(self.expected_pages(include_copy=True))
+        self.assertEqual(
+            sorted(self.read_csv("no_recognized.csv")["ファイル名"]),
+            ["e-broken.jpg", "f-notes.txt"]
+        )
+
+    def test_parallel_summarize_error(self):
+        """集計中に例外が発生しても、子プロセスを終了させて例外を送出すること
+        """
+        main.COMMANDLINE_OPTIONS.workers = 2
+        self.reader.ring_slots = 2
+        summarize_image = main.summarize_image
+        n_called = []
+
+        def fail_on_third_page(*args):
+            n_called.append(1)
+            if len(n_called) == 3:
+                raise ValueError("summarize failed")
+            return summarize_image(*args)
+
+        with mock.patch.object(main, "summarize_image", fail_on_third_page):
+            with self.assertRaisesRegex(ValueError, "summarize failed"):
+                self.run_pipeline()
+        self.assertEqual(multiprocessing.active_children(), [])
+
+    def test_parallel_worker_crash(self):
+        """子プロセスが異常終了した場合は待ち続けずに例外を送出すること
+        """
+        main.COMMANDLINE_OPTIONS.workers = 2
+        with mock.patch.object(main, "decode_worker", crash_worker):
+            with self.assertRaisesRegex(RuntimeError, "異常終了"):
+                self.run_pipeline()
+        self.assertEqual(multiprocessing.active_children(), [])
@@ -3,8 +3,275 @@
 #    単体テストケース
 ###############################################################################
 from unittest import TestCase
+import os
+import tempfile
+import numpy as np
+import cv2
 import marksheet_reader
+from marksheet_fixture import make_marksheet_image
+
+# テスト用のサンプル画像
+SAMPLE_PATHS = [
+    "./sample/sample-marksheet_01_200dpi.jpg",
+    "./sample/sample-marksheet_02_200dpi.jpg",
+]
+
+# サンプル画像の正しい読み取り結果 (ページ番号, 設問ごとの回答番号)
+SAMPLE_EXPECTED = [
+    (1, [[1], [2], [3], [1], [6], [5], [3], [2], [4], [1, 2]]),
+    (2, [
+        [1, 2], [2, 3], [3, 4], [1, 3], [1, 4], [2, 4], [1, 2, 3],
+        [2, 3, 4], [1, 3, 4], [1, 2, 4], [1], [2], [], []
+    ]),
+]
+
+# 生成するマークシートの回答 (ページ番号, 設問ごとの回答番号)
+SYNTHETIC_ANSWERS = [
+    (1, [[1], [2, 3], [], [6], [4], [5], [1], [2], [3], [1, 6]]),
+    (2, [
+        [6], [5], [4], [3], [2], [1], [], [1, 2, 3, 4, 5, 6],
+        [2], [3], [4], [5], [6], [1]
+    ]),
+]
 
 
 class TestMarksheetReader(TestCase):
-    pass
+
+    def setUp(self):
+        self.reader = marksheet_reader.MarksheetReader(0.5, False)
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def recognize(self, path: str):
+        """画像ファイルを読み取り、ページ番号と設問ごとの回答番号のリストを返します。
+        """
+        image = self.reader.load_marksheet(path)
+        if image is None:
+            return None
+        page_number, results = self.reader.recognize_marksheet(image, path)
+        if results is None:
+            return page_number, None
+        return page_number, [
+            [int(x) for x in self.reader.get_answer(np.asarray(result))]
+            for result in results
+        ]
+
+    def write_image(self, name: str, image: np.ndarray) -> str:
+        """一時ディレクトリーに画像を書き出してパスを返します。
+        """
+        path = os.path.join(self.temp_dir.name, name)
+        cv2.imwrite(path, image)
+        return path
+
+    def test_sample(self):
+        """サンプル画像を正しく読み取れること
+        """
+        for path, expected in zip(SAMPLE_PATHS, SAMPLE_EXPECTED):
+            with self.subTest(path=path):
+                self.assertEqual(self.recognize(path), expected)
+
+    def test_synthetic(self):
+        """生成したマークシートを正しく読み取れること
+        """
+        for page_number, answers in SYNTHETIC_ANSWERS:
+            with self.subTest(page_number=page_number):
+                path = self.write_image(
+                    f"synthetic-p{page_number}.png",
+                    make_marksheet_image(self.reader, page_number, answers)
+                )
+                self.assertEqual(
+                    self.recognize(path), (page_number, answers)
+                )
+
+    def test_synthetic_resolution(self):
+        """スキャン解像度が異なっても、切り出して同じサイズに揃えてから読み取れること
+        """
+        page_number, answers = SYNTHETIC_ANSWERS[1]
+        path = self.write_image(
+            "synthetic-large.png",
+            make_marksheet_image(
+                self.reader, page_number, answers,
+                cell_width=240, cell_height=64
+            )
+        )
+        image = self.reader.load_marksheet(path)
+        self.assertEqual(
+            image.shape,
+            (
+                self.reader.total_row * self.reader.cell_size,
+                self.reader.n_col * self.reader.cell_size
+            )
+        )
+        self.assertEqual(self.recognize(path), (page_number, answers))
+
+    def test_unknown_page_number(self):
+        """ページ番号が塗りつぶされていない場合は 0 を返すこと
+        """
+        path = self.write_image(
+            "synthetic-no-page.png",
+            make_marksheet_image(self.reader, 0, [])
+        )
+        self.assertEqual(self.recognize(path), (0, None))
+
+    def test_load_error(self):
+        """読み込めない画像の場合は None を返すこと
+        """
+        # 対応していない拡張子
+        path = os.path.join(self.temp_dir.name, "sheet.gif")
+        open(path, "wb").close()
+        self.assertIsNone(self.reader.load_marksheet(path))
+
+        # 画像として読み込めない
+        path = os.path.join(self.temp_dir.name, "broken.jpg")
+        with open(path, "wb") as f:
+            f.write(b"not an image")
+        self.assertIsNone(self.reader.load_marksheet(path))
+
+        # マーカーがない
+        path = self.write_image(
+            "blank.png", np.full((2000, 1500), 255, dtype=np.uint8)
+        )
+        self.assertIsNone(self.reader.load_marksheet(path))
+
+    def test_load_mapped(self):
+        """PGM と RAW をメモリーマップで読み込み、同じ画像に整形できること
+        """
+        gray = cv2.imread(SAMPLE_PATHS[0], cv2.IMREAD_GRAYSCALE)
+        expected = self.reader.load_marksheet(
+            self.write_image("sheet.png", gray)
+        )
+
+        pgm_path = self.write_image("sheet.pgm", gray)
+        raw_path = os.path.join(self.temp_dir.name, "sheet.raw")
+        gray.tofile(raw_path)
+
+        # 16ビットの PGM (コメント付きのヘッダー)
+        pgm16_path = os.path.join(self.temp_dir.name, "sheet16.pgm")
+        with open(pgm16_path, "wb") as f:
+            f.write(b"P5\n# scanner\n%d %d\n65535\n" % gray.shape[::-1])
+            (gray.astype(">u2") * 257).tofile(f)
+
+        # 8ビットの画像はコピーせずにメモリーマップのまま返す
+        self.assertIsInstance(self.reader.read_image(pgm_path), np.memmap)
+        self.assertIsInstance(self.reader.read_image(raw_path), np.memmap)
+        for path in [pgm_path, raw_path, pgm16_path]:
+            with self.subTest(path=path):
+                self.assertTrue(
+                    np.array_equal(self.reader.load_marksheet(path), expected)
+                )
+
+        # RAW の大きさが設定と異なる
+        path = os.path.join(self.temp_dir.name, "short.raw")
+        gray[:100].tofile(path)
+        self.assertIsNone(self.reader.load_marksheet(path))
+        self.assertEqual(
+            self.reader.last_error, marksheet_reader.LOAD_ERROR_IMREAD
+        )
+
+        # PGM のヘッダーが壊れている
+        path = os.path.join(self.temp_dir.name, "broken.pgm")
+        with open(path, "wb") as f:
+            f.write(b"P6\n1 1\n255\n\0\0\0")
+        self.assertIsNone(self.reader.load_marksheet(path))
+        self.assertEqual(
+            self.reader.last_error, marksheet_reader.LOAD_ERROR_IMREAD
+        )
+
+    def test_load_into_buffer(self):
+        """out を指定した場合は、整形後の画像を out に直接書き込むこと
+        """
+        expected = self.reader.load_marksheet(SAMPLE_PATHS[0])
+        out = np.zeros_like(expected)
+        self.assertIs(self.reader.load_marksheet(SAMPLE_PATHS[0], out=out), out)
+        self.assertTrue(np.array_equal(out, expected))
+
+    def test_load_in_memory(self):
+        """ファイルの内容や配列を渡して、ファイルと同じ画像に整形できること
+        """
+        gray = cv2.imread(SAMPLE_PATHS[0], cv2.IMREAD_GRAYSCALE)
+        expected = self.reader.load_marksheet(
+            self.write_image("sheet.png", gray)
+        )
+
+        for name, image in [
+                ("sheet.png", gray),
+                ("sheet.pgm", gray),
+        ]:
+            with self.subTest(name=name):
+                _, data = cv2.imencode(os.path.splitext(name)[1], image)
+                self.assertTrue(np.array_equal(
+                    self.reader.load_marksheet(name, data.tobytes()), expected
+                ))
+        with self.subTest(name="sheet.raw"):
+            self.assertTrue(np.array_equal(
+                self.reader.load_marksheet("sheet.raw", gray.tobytes()),
+                expected
+            ))
+        with self.subTest(name="ndarray"):
+            self.assertTrue(np.array_equal(
+                self.reader.load_marksheet("scan", gray), expected
+            ))
+            self.assertTrue(np.array_equal(
+                self.reader.load_marksheet(
+                    "scan", cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+                ),
+                expected
+            ))
+
+        # 先頭の画素が "P5" と同じ値でも RAW として読む
+        raw = gray.copy()
+        raw[0, :2] = [ord("P"), ord("5")]
+        self.assertIsNotNone(
+            self.reader.load_marksheet("sheet.raw", raw.tobytes())
+        )
+
+        # 画像として読み込めない
+        for name, data in [
+                ("sheet.jpg", b"broken"),
+                ("sheet.jpg", b""),
+                ("sheet.raw", b""),
+                ("scan", np.zeros((0, 0), dtype=np.uint8)),
+                ("scan", np.zeros((0, 100, 3), dtype=np.uint8)),
+                ("scan", gray.astype(np.uint16)),
+                ("scan", gray.astype(np.float64)),
+                ("scan", cv2.cvtColor(gray, cv2.COLOR_GRAY2BGRA)),
+        ]:
+            with self.subTest(name=name, data=type(data)):
+                self.assertIsNone(self.reader.load_marksheet(name, data))
+                self.assertEqual(
+                    self.reader.last_error, marksheet_reader.LOAD_ERROR_IMREAD
+                )
+
+    def test_calibrate(self):
+        """自動調整した閾値でもサンプル画像の読み取り結果が変わらないこと
+        """
+        def recognize():
+            return [
+                self.reader.recognize_marksheet(
+                    self.reader.load_marksheet(x), x
+                )
+                for x in SAMPLE_PATHS
+            ]
+
+        expected = recognize()
+        calibration = self.reader.calibrate(SAMPLE_PATHS)
+        actual = recognize()
+
+        self.assertEqual(len(calibration["sample_files"]), len(SAMPLE_PATHS))
+        for (page_number, results), (expected_page_number, expected_results) \
+                in zip(actual, expected):
+            self.assertEqual(page_number, expected_page_number)
+            self.assertEqual(
+                [list(x) for x in results],
+                [list(x) for x in expected_results]
+            )
+
+    def test_otsu_threshold(self):
+        """２つの山の間に谷がある場合は谷の中央を閾値とすること
+        """
+        hist = np.zeros(256)
+        hist[:10] = 5
+        hist[250:] = 100
+        self.assertEqual(marksheet_reader.otsu_threshold(hist), 129)
@@ -0,0 +1,68 @@
+# coding: utf-8
+###############################################################################
+#    単体テストケース
+###############################################################################
+from unittest import TestCase
+import os
+import json
+import tempfile
+import urllib.request
+from run_stats import RunStats, STAGE_RECOGNIZED, STAGE_PAGE_UNKNOWN
+
+
+class TestRunStats(TestCase):
+
+    def setUp(self):
+        self.stats = RunStats(10, 3, 2)
+        self.stats.record("a.jpg", STAGE_RECOGNIZED, 0.3)
+        self.stats.record("b.jpg", "marker_not_found", 0.1)
+        self.stats.record("c.jpg", STAGE_RECOGNIZED, 0.5)
+        self.stats.record("d.jpg", STAGE_PAGE_UNKNOWN, 0.2)
+
+    def tearDown(self):
+        self.stats.finish()
+
+    def test_snapshot(self):
+        """段階別の件数・直近の失敗率・処理時間の長いページを集計すること
+        """
+        snapshot = self.stats.snapshot()
+        self.assertEqual(snapshot["processed"], 4)
+        self.assertEqual(
+            snapshot["counts"],
+            {
+                STAGE_RECOGNIZED: 2,
+                "marker_not_found": 1,
+                STAGE_PAGE_UNKNOWN: 1,
+            }
+        )
+        self.assertAlmostEqual(snapshot["rolling_failure_rate"], 2 / 3)
+        self.assertEqual(
+            [x["file_name"] for x in snapshot["slowest_pages"]],
+            ["c.jpg", "a.jpg"]
+        )
+        self.assertGreater(snapshot["rolling_pages_per_sec"], 0)
+        self.assertGreater(snapshot["eta_sec"], 0)
+
+    def test_write_report(self):
+        """統計と追加情報を run_report.json に書き出すこと
+        """
+        self.stats.finish()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.stats.write_report(temp_dir, {"duplicates": 1})
+            with open(
+                    os.path.join(temp_dir, "run_report.json"),
+                    encoding="utf-8"
+            ) as f:
+                report = json.load(f)
+        self.assertEqual(report["total"], 10)
+        self.assertEqual(report["counts"][STAGE_RECOGNIZED], 2)
+        self.assertEqual(report["duplicates"], 1)
+
+    def test_serve(self):
+        """統計をテキストで公開すること
+        """
+        port = self.stats.serve(0)
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/") as res:
+            text = res.read().decode("utf-8")
+        self.assertIn("processed: 4", text)
+        self.assertIn("counts.marker_not_found: 1", text)
@@ -0,0 +1,50 @@
+# coding: utf-8
+###############################################################################
+#    単体テストケース
+###############################################################################
+from unittest import TestCase
+import queue
+import numpy as np
+import multiprocessing
+from shared_page_ring import SharedPageRing
+
+
+def write_pages(ring: SharedPageRing, n_page: int):
+    """子プロセスでページ番号を値とした画像を書き込みます。
+    """
+    for i in range(n_page):
+        slot = ring.acquire()
+        ring.view(slot)[:] = i
+        ring.publish(slot, i)
+    ring.close()
+
+
+class TestSharedPageRing(TestCase):
+
+    def test_transfer(self):
+        """子プロセスで書き込んだ画像をそのまま受け取れること
+        """
+        with SharedPageRing(2, (4, 3)) as ring:
+            worker = multiprocessing.Process(
+                target=write_pages, args=(ring, 5)
+            )
+            worker.start()
+            for i in range(5):
+                slot, item = ring.get(timeout=10)
+                page = ring.view(slot)
+                self.assertEqual(item, i)
+                self.assertEqual(page.shape, (4, 3))
+                self.assertTrue((page == i).all())
+                del page
+                ring.release(slot)
+            worker.join()
+
+    def test_backpressure(self):
+        """空きスロットがなくなると acquire が待機すること
+        """
+        with SharedPageRing(1, (2, 2)) as ring:
+            slot = ring.acquire(timeout=1)
+            with self.assertRaises(queue.Empty):
+                ring.acquire(timeout=0.1)
+            ring.release(slot)
+            self.assertEqual(ring.acquire(timeout=1), slot)